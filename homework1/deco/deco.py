@@ -1,7 +1,41 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import cPickle as pickle
+import hashlib
+import inspect
+import itertools
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from cStringIO import StringIO
 from functools import update_wrapper
+from thread import get_ident
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+# marks where keyword arguments start in a cache key
+KWARGS_MARK = object()
+# a single argument of these types is used as the key itself
+FAST_KEY_TYPES = (int, long, str, unicode)
+# fields of a link in the LRU list
+PREV, NEXT, KEY, RESULT, EXPIRES = 0, 1, 2, 3, 4
+
+# DECO_PROFILE=0 turns profile into a no-op
+PROFILE_ENABLED = os.environ.get('DECO_PROFILE', '1') != '0'
+# FunctionProfile of every profiled function
+PROFILES = []
+# the last bucket takes everything from about 18 minutes on
+HISTOGRAM_BUCKETS = 31
+# per thread stack of time spent in callees of the running profiled calls
+profile_state = threading.local()
+timer = time.time
 
 
 def disable():
@@ -33,36 +67,518 @@ def decorator(func_1):
 def countcalls(fn):
     '''Decorator that counts calls made to the function decorated.'''
 
-    @decorator(fn)
-    def wrapper(*args):
-        if not hasattr(fn, 'calls'):
-            fn.calls = 1
+    def wrapper(*args, **kwargs):
+        wrapper.calls += 1
+        return fn(*args, **kwargs)
+
+    update_wrapper(wrapper, fn)
+    wrapper.calls = 0
+    return wrapper
+
+
+class FunctionProfile(object):
+    '''
+    Call count, cumulative and self time (in seconds) and a latency
+    histogram of one function. Histogram bucket i counts calls that
+    took less than 2 ** i microseconds (and at least half of that).
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.total = 0.0
+        self.own = 0.0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, elapsed, own, outermost):
+        self.calls += 1
+        self.own += own
+        # recursive calls are already inside the outermost one
+        if outermost:
+            self.total += elapsed
+        bucket = min(int(elapsed * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)
+        self.histogram[bucket] += 1
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'calls': self.calls,
+            'total': self.total,
+            'self': self.own,
+            'histogram': [{'lt_us': 1 << i, 'count': count}
+                          for i, count in enumerate(self.histogram) if count],
+        }
+
+
+def profile(fn):
+    '''
+    Record calls, cumulative and self time and a latency histogram of
+    the function decorated in the global PROFILES registry. With
+    DECO_PROFILE=0 in the environment fn is returned unchanged.
+    Counters are not locked, so they are approximate under threads.
+    '''
+    if not PROFILE_ENABLED:
+        return fn
+    stats = FunctionProfile(fn.__module__ + '.' + fn.__name__)
+    PROFILES.append(stats)
+    local = threading.local()
+
+    def wrapper(*args, **kwargs):
+        try:
+            stack = profile_state.stack
+        except AttributeError:
+            stack = profile_state.stack = []
+        depth = getattr(local, 'depth', 0)
+        local.depth = depth + 1
+        # time spent in profiled callees, subtracted to get self time
+        stack.append(0.0)
+        started = timer()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = timer() - started
+            local.depth = depth
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            stats.add(elapsed, elapsed - children, depth == 0)
+
+    update_wrapper(wrapper, fn)
+    wrapper.profile = stats
+    return wrapper
+
+
+def profile_report(sort='total'):
+    '''Profiles as a text table, sorted by total, self or calls.'''
+    key = {'total': 'total', 'self': 'own', 'calls': 'calls'}[sort]
+    lines = ['%-30s %8s %12s %12s %12s' % ('function', 'calls', 'total ms', 'self ms', 'self us/call')]
+    for stats in sorted(PROFILES, key=lambda stats: getattr(stats, key), reverse=True):
+        mean = stats.own / stats.calls * 1e6 if stats.calls else 0.0
+        lines.append('%-30s %8d %12.3f %12.3f %12.2f' % (
+            stats.name, stats.calls, stats.total * 1e3, stats.own * 1e3, mean))
+    return '\n'.join(lines)
+
+
+def profile_json():
+    return json.dumps([stats.as_dict() for stats in PROFILES], indent=2)
+
+
+def profile_reset():
+    for stats in PROFILES:
+        stats.reset()
+
+
+def make_key(args, kwargs):
+    '''
+    Build a cache key from the actual arguments, so ('1 2',) and (1, 2)
+    get different keys. All arguments must be hashable.
+    '''
+    if kwargs:
+        return args + (KWARGS_MARK,) + tuple(sorted(kwargs.items()))
+    if len(args) == 1 and type(args[0]) in FAST_KEY_TYPES:
+        return args[0]
+    return args
+
+
+def mirror_attributes(wrapper, fn, own):
+    '''
+    Copy attributes fn got while running (like countcalls' calls) to
+    wrapper, then restore the wrapper's own attributes. Memo wrappers
+    call this after each miss: fn only runs on misses, so that is the
+    only time its attributes can change.
+    '''
+    fn_dict = getattr(fn, '__dict__', None)
+    if fn_dict:
+        wrapper.__dict__.update(fn_dict)
+        wrapper.__dict__.update(own)
+
+
+def memo(fn=None, maxsize=None, ttl=None, clock=time.time):
+    '''
+    Memoize a function so that it caches its return values for
+    faster future lookups. Use as @memo or @memo(maxsize=..., ttl=...).
+
+    With maxsize the least recently used result is evicted once the
+    cache is full; with ttl results expire after ttl seconds.
+    The wrapper gets cache_info() and cache_clear().
+    '''
+    if fn is None:
+        return lambda fn: memo(fn, maxsize, ttl, clock)
+    if maxsize is None and ttl is None:
+        wrapper = unbounded_memo(fn)
+    else:
+        wrapper = lru_memo(fn, maxsize, ttl, clock)
+    return wrapper
+
+
+def unbounded_memo(fn):
+    cache = {}
+    stats = [0, 0]
+    missing = object()
+
+    def wrapper(*args, **kwargs):
+        key = make_key(args, kwargs)
+        result = cache.get(key, missing)
+        if result is not missing:
+            stats[0] += 1
+            return result
+        stats[1] += 1
+        result = cache[key] = fn(*args, **kwargs)
+        mirror_attributes(wrapper, fn, own)
+        return result
+
+    def cache_clear():
+        cache.clear()
+        stats[:] = [0, 0]
+
+    own = {
+        'cache_info': lambda: CacheInfo(stats[0], stats[1], None, len(cache)),
+        'cache_clear': cache_clear,
+    }
+    update_wrapper(wrapper, fn)
+    wrapper.__dict__.update(own)
+    return wrapper
+
+
+def lru_memo(fn, maxsize, ttl, clock):
+    '''
+    Memo with a dict of links in a circular doubly linked list ordered
+    from the least to the most recently used, so lookup, move to the
+    end and eviction are all O(1). Expired results are dropped when
+    they are looked up or reach the head of the list.
+    '''
+    cache = {}
+    # fn is called outside the lock, so a plain (C level) Lock is enough
+    lock = threading.Lock()
+    root = []
+    root[:] = [root, root, None, None, None]
+    stats = [0, 0]
+
+    def unlink(link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def wrapper(*args, **kwargs):
+        key = make_key(args, kwargs)
+        with lock:
+            link = cache.get(key)
+            if link is not None:
+                if ttl is None or link[EXPIRES] > clock():
+                    unlink(link)
+                    last = root[PREV]
+                    last[NEXT] = root[PREV] = link
+                    link[PREV] = last
+                    link[NEXT] = root
+                    stats[0] += 1
+                    return link[RESULT]
+                unlink(link)
+                del cache[key]
+            stats[1] += 1
+        result = fn(*args, **kwargs)
+        mirror_attributes(wrapper, fn, own)
+        if maxsize is not None and maxsize <= 0:
+            return result
+        with lock:
+            if key in cache:
+                # another thread stored it while we were computing
+                return result
+            now = clock() if ttl is not None else None
+            oldest = root[NEXT]
+            full = maxsize is not None and len(cache) >= maxsize
+            if oldest is not root and (full or now is not None and oldest[EXPIRES] <= now):
+                unlink(oldest)
+                del cache[oldest[KEY]]
+            last = root[PREV]
+            link = [last, root, key, result, now + ttl if now is not None else None]
+            last[NEXT] = root[PREV] = cache[key] = link
+        return result
+
+    def cache_clear():
+        with lock:
+            cache.clear()
+            root[:] = [root, root, None, None, None]
+            stats[:] = [0, 0]
+
+    own = {
+        'cache_info': lambda: CacheInfo(stats[0], stats[1], maxsize, len(cache)),
+        'cache_clear': cache_clear,
+    }
+    update_wrapper(wrapper, fn)
+    wrapper.__dict__.update(own)
+    return wrapper
+
+
+class Flight(object):
+    '''A computation of one key that other threads can wait for.'''
+
+    def __init__(self):
+        self.owner = threading.current_thread()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def concurrent_memo(fn=None, stripes=16):
+    '''
+    Thread-safe memo. Keys are spread over striped locks, so callers of
+    different keys rarely contend. Concurrent callers of the same
+    missing key wait for a single computation; if it raises, every
+    waiter gets the exception and nothing is cached.
+    '''
+    if fn is None:
+        return lambda fn: concurrent_memo(fn, stripes)
+    cache = {}
+    flights = {}
+    locks = [threading.Lock() for _ in range(stripes)]
+    # hits are counted without a lock and may be slightly off under threads
+    hits = [0]
+    misses = [0] * stripes
+    missing = object()
+
+    def wrapper(*args, **kwargs):
+        key = make_key(args, kwargs)
+        result = cache.get(key, missing)
+        if result is not missing:
+            hits[0] += 1
+            return result
+        stripe = hash(key) % stripes
+        with locks[stripe]:
+            result = cache.get(key, missing)
+            if result is not missing:
+                hits[0] += 1
+                return result
+            flight = flights.get(key)
+            leader = flight is None
+            if leader:
+                misses[stripe] += 1
+                flight = flights[key] = Flight()
+        if not leader:
+            if flight.owner is threading.current_thread():
+                raise RuntimeError('%s calls itself with the same arguments' % fn.__name__)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error[0], flight.error[1], flight.error[2]
+            hits[0] += 1
+            return flight.result
+        try:
+            flight.result = fn(*args, **kwargs)
+            mirror_attributes(wrapper, fn, own)
+        except BaseException:
+            flight.error = sys.exc_info()
+            raise
         else:
-            fn.calls += 1
-        wrapper.calls = fn.calls
-        return fn(*args)
+            cache[key] = flight.result
+            return flight.result
+        finally:
+            with locks[stripe]:
+                del flights[key]
+            flight.done.set()
+
+    def cache_clear():
+        for lock in locks:
+            lock.acquire()
+        try:
+            cache.clear()
+            hits[0] = 0
+            misses[:] = [0] * stripes
+        finally:
+            for lock in locks:
+                lock.release()
 
+    own = {
+        'cache_info': lambda: CacheInfo(hits[0], sum(misses), None, len(cache)),
+        'cache_clear': cache_clear,
+    }
+    update_wrapper(wrapper, fn)
+    wrapper.__dict__.update(own)
     return wrapper
 
 
-def memo(fn):
+class SqliteStore(object):
     '''
-    Memoize a function so that it caches all return values for
-    faster future lookups.
+    Pickled results in an SQLite file shared by threads and processes.
+    WAL mode lets readers work while another process writes, writers
+    wait up to timeout seconds for the lock.
+
+    Eviction is least recently used: a hit refreshes the row's last use
+    at most once per touch_interval seconds, so hits rarely write. Every
+    few inserts the store is trimmed back to maxsize rows, so it may
+    exceed maxsize by a few rows per process in between.
+
+    Values are unpickled, so the file must be trusted: it and its WAL
+    files must belong to the current user.
     '''
 
-    @decorator(fn)
-    def wrapper(*args):
-        args_val = ' '.join(map(lambda x: str(x), args))
-        if not hasattr(fn, 'saved_args'):
-            fn.saved_args = {
-                args_val: fn(*args)
-            }
+    def __init__(self, path, maxsize=100000, timeout=30.0, touch_interval=60.0, clock=time.time):
+        self.path = path
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.touch_interval = touch_interval
+        self.clock = clock
+        self.trim_every = max(1, min(128, maxsize // 8))
+        self.inserts = itertools.count(1)
+        self.local = threading.local()
+
+    def connection(self):
+        # sqlite connections can't be shared between threads or across fork
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            # checked before the first statement reads the file
+            for path in (self.path, self.path + '-wal', self.path + '-shm'):
+                check_owner(path)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS results '
+                '(key TEXT PRIMARY KEY, name TEXT, version TEXT, value BLOB, used REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+            connection.execute('CREATE INDEX IF NOT EXISTS results_name ON results (name, version)')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        '''Return (True, value) or (False, None) if key is missing.'''
+        connection = self.connection()
+        row = connection.execute('SELECT value, used FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return False, None
+        try:
+            value = pickle.loads(str(row[0]))
+        except Exception:
+            # written by an incompatible version, compute it again
+            return False, None
+        now = self.clock()
+        if now - row[1] >= self.touch_interval:
+            connection.execute('UPDATE results SET used = ? WHERE key = ?', (now, key))
+        return True, value
+
+    def set(self, key, name, version, value):
+        data = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        connection = self.connection()
+        connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                           (key, name, version, data, self.clock()))
+        if next(self.inserts) % self.trim_every == 0:
+            self.trim()
+
+    def trim(self):
+        connection = self.connection()
+        extra = connection.execute('SELECT COUNT(*) FROM results').fetchone()[0] - self.maxsize
+        if extra > 0:
+            connection.execute(
+                'DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY used LIMIT ?)', (extra,))
+
+    def clear(self, name=None):
+        if name is None:
+            self.connection().execute('DELETE FROM results')
         else:
-            if args_val not in fn.saved_args:
-                fn.saved_args[args_val] = fn(*args)
-        update_wrapper(wrapper, fn)
-        return fn.saved_args[args_val]
+            self.connection().execute('DELETE FROM results WHERE name = ?', (name,))
+
+    def count(self, name, version):
+        return self.connection().execute(
+            'SELECT COUNT(*) FROM results WHERE name = ? AND version = ?', (name, version)).fetchone()[0]
+
+
+def check_owner(path):
+    '''Refuse files another user could have planted.'''
+    try:
+        owner = os.stat(path).st_uid
+    except OSError:
+        return
+    if owner != os.getuid():
+        raise IOError('%s belongs to another user, refusing to unpickle from it' % path)
+
+
+# (path, maxsize, timeout) -> SqliteStore, so functions memoized in one file share connections
+STORES = {}
+STORES_LOCK = threading.Lock()
+DEFAULT_STORE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'deco')
+
+
+def default_store_path():
+    '''
+    $DECO_MEMO_PATH or memo.sqlite in a private (0700) directory of the
+    current user, never a predictable file in a shared directory.
+    '''
+    if os.environ.get('DECO_MEMO_PATH'):
+        return os.environ['DECO_MEMO_PATH']
+    if not os.path.isdir(DEFAULT_STORE_DIR):
+        os.makedirs(DEFAULT_STORE_DIR, 0o700)
+    check_owner(DEFAULT_STORE_DIR)
+    if os.stat(DEFAULT_STORE_DIR).st_mode & 0o022:
+        raise IOError('%s is writable by other users' % DEFAULT_STORE_DIR)
+    return os.path.join(DEFAULT_STORE_DIR, 'memo.sqlite')
+
+
+def get_store(path, maxsize, timeout):
+    with STORES_LOCK:
+        key = (path, maxsize, timeout)
+        store = STORES.get(key)
+        if store is None:
+            store = STORES[key] = SqliteStore(path, maxsize, timeout)
+        return store
+
+
+def source_version(fn):
+    '''Hash of the function's source, or of its bytecode if there is none.'''
+    try:
+        source = inspect.getsource(fn)
+    except (IOError, TypeError):
+        source = getattr(getattr(fn, '__code__', None), 'co_code', '')
+    return hashlib.sha1(source).hexdigest()
+
+
+def stable_dumps(value):
+    '''
+    Pickle without the memo, so equal values give equal bytes whether
+    or not they share objects (e.g. interned strings).
+    '''
+    data = StringIO()
+    pickler = pickle.Pickler(data, 2)
+    pickler.fast = 1
+    pickler.dump(value)
+    return data.getvalue()
+
+
+def persistent_memo(fn=None, path=None, maxsize=100000, version=None, timeout=30.0):
+    '''
+    Memoize a pure function on disk, so results survive the process and
+    are shared by all processes using the same file (see
+    default_store_path). The key is a sha1 of the qualified name, the
+    version (by default a hash of the source) and the pickled arguments.
+    Results must be picklable. cache_info().currsize counts the results
+    of this function and version, cache_clear() drops all its results.
+    '''
+    if fn is None:
+        return lambda fn: persistent_memo(fn, path, maxsize, version, timeout)
+    store = get_store(path or default_store_path(), maxsize, timeout)
+    name = fn.__module__ + '.' + fn.__name__
+    version = version or source_version(fn)
+    prefix = stable_dumps((name, version))
+    stats = [0, 0]
+
+    def wrapper(*args, **kwargs):
+        key = hashlib.sha1(prefix + stable_dumps((args, sorted(kwargs.items())))).hexdigest()
+        found, result = store.get(key)
+        if found:
+            stats[0] += 1
+            return result
+        stats[1] += 1
+        result = fn(*args, **kwargs)
+        mirror_attributes(wrapper, fn, own)
+        store.set(key, name, version, result)
+        return result
+
+    own = {
+        'cache_info': lambda: CacheInfo(stats[0], stats[1], maxsize, store.count(name, version)),
+        'cache_clear': lambda: store.clear(name),
+    }
+    update_wrapper(wrapper, fn)
+    wrapper.__dict__.update(own)
     return wrapper
 
 
@@ -80,8 +596,20 @@ def n_ary(fn):
     return wrapper
 
 
+def call_str(name, args):
+    return name + '(' + ''.join(map(lambda x: str(x), args)) + ')'
+
+
 def fn_call_str(fn, args):
-    return fn.__name__ + '(' + ''.join(map(lambda x: str(x), args)) + ')'
+    return call_str(fn.__name__, args)
+
+
+def enter_line(symb, level, call):
+    return symb * level + ' --> ' + call
+
+
+def exit_line(symb, level, call, res):
+    return symb * level + ' <-- ' + call + ' == ' + str(res)
 
 
 def trace(symb):
@@ -114,21 +642,9 @@ def trace(symb):
             else:
                 fn.level += 1
 
-            level_str = ''
-            for i in range(0, fn.level):
-                level_str += symb
-
-            level_str += ' --> ' + fn_call_str(fn, args)
-            print(level_str)
-
+            print(enter_line(symb, fn.level, fn_call_str(fn, args)))
             res = fn(*args)
-
-            level_str = ''
-            for i in range(0, fn.level):
-                level_str += symb
-
-            level_str += ' <-- ' + fn_call_str(fn, args) + ' == ' + str(res)
-            print(level_str)
+            print(exit_line(symb, fn.level, fn_call_str(fn, args), res))
             fn.level -= 1
             return res
         return wrapper
@@ -136,6 +652,125 @@ def trace(symb):
     return fn_wrapper
 
 
+class TraceBuffer(object):
+    '''
+    Ring of the last size trace events, older events are overwritten.
+    An event is (phase, name, args, result, depth, timestamp, thread),
+    phase is 'B' on enter and 'E' on exit as in Chrome trace events.
+    '''
+
+    def __init__(self, size=65536):
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        self.events = [None] * self.size
+        # next() on a count is atomic, so threads never get the same slot
+        self.counter = itertools.count()
+        self.written = 0
+
+    def add(self, event):
+        index = next(self.counter)
+        self.events[index % self.size] = event
+        self.written = index + 1
+
+    def __iter__(self):
+        '''Events from the oldest to the newest.'''
+        written = self.written
+        for index in xrange(max(0, written - self.size), written):
+            event = self.events[index % self.size]
+            if event is not None:
+                yield event
+
+    def dropped(self):
+        return max(0, self.written - self.size)
+
+
+TRACE_BUFFER = TraceBuffer()
+# depth of ring_trace calls in this thread and whether they are sampled
+trace_state = threading.local()
+
+
+def ring_trace(fn=None, buffer=None, sample=1.0):
+    '''
+    Record enter and exit events of the function decorated in a
+    TraceBuffer (TRACE_BUFFER by default) instead of printing them.
+    A sample share of the outermost calls is recorded together with
+    everything they call, so recorded call trees are never cut.
+    Arguments and results are kept as is and turned into text only by
+    render_trace and chrome_trace.
+    '''
+    if fn is None:
+        return lambda fn: ring_trace(fn, buffer, sample)
+    add = (buffer or TRACE_BUFFER).add
+    name = fn.__name__
+
+    def wrapper(*args, **kwargs):
+        depth = getattr(trace_state, 'depth', 0)
+        if depth == 0:
+            trace_state.sampled = random.random() < sample
+        trace_state.depth = depth + 1
+        try:
+            if not trace_state.sampled:
+                return fn(*args, **kwargs)
+            thread = get_ident()
+            add(('B', name, args, None, depth, timer(), thread))
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as error:
+                add(('E', name, args, error, depth, timer(), thread))
+                raise
+            add(('E', name, args, result, depth, timer(), thread))
+            return result
+        finally:
+            trace_state.depth = depth
+
+    update_wrapper(wrapper, fn)
+    return wrapper
+
+
+def matched_events(events):
+    '''Skip exits whose enter was already overwritten in the ring.'''
+    open_calls = {}
+    for event in events:
+        thread = event[6]
+        if event[0] == 'B':
+            open_calls[thread] = open_calls.get(thread, 0) + 1
+        elif open_calls.get(thread):
+            open_calls[thread] -= 1
+        else:
+            continue
+        yield event
+
+
+def render_trace(events=None, symb='____'):
+    '''Events as text in the format printed by trace.'''
+    lines = []
+    for phase, name, args, result, depth, _, _ in matched_events(TRACE_BUFFER if events is None else events):
+        call = call_str(name, args)
+        if phase == 'B':
+            if depth == 0:
+                lines.append('->>>' + call)
+            lines.append(enter_line(symb, depth, call))
+        else:
+            lines.append(exit_line(symb, depth, call, result))
+    return '\n'.join(lines)
+
+
+def chrome_trace(events=None):
+    '''Events as Chrome trace event JSON (chrome://tracing, Perfetto, speedscope).'''
+    pid = os.getpid()
+    trace_events = []
+    for phase, name, args, result, depth, timestamp, thread in matched_events(TRACE_BUFFER if events is None else events):
+        if phase == 'B':
+            details = {'args': ', '.join(map(repr, args))}
+        else:
+            details = {'result': repr(result)}
+        trace_events.append({'name': name, 'ph': phase, 'ts': timestamp * 1e6,
+                             'pid': pid, 'tid': thread, 'args': details})
+    return json.dumps({'traceEvents': trace_events, 'displayTimeUnit': 'ms'})
+
+
 @memo
 @countcalls
 @n_ary
@@ -151,6 +786,7 @@ def bar(a, b):
 
 
 @countcalls
+@profile
 @memo
 @trace("####")
 def fib(n):
@@ -158,6 +794,11 @@ def fib(n):
     return 1 if n <= 1 else fib(n-1) + fib(n-2)
 
 
+@ring_trace
+def ring_fib(n):
+    return 1 if n <= 1 else ring_fib(n-1) + ring_fib(n-2)
+
+
 def main():
     print foo(4, 3)
     print foo(4, 3, 2)
@@ -172,7 +813,305 @@ def main():
     print fib.__doc__
     fib(4)
     print fib.calls, 'calls made'
+    if PROFILE_ENABLED:
+        print profile_report()
+
+    ring_fib(3)
+    print render_trace(TRACE_BUFFER, '####')
+
+
+def test_memo():
+    print "test_memo..."
+    calls = []
+
+    def record(*args, **kwargs):
+        calls.append((args, kwargs))
+        return len(calls)
+
+    unbounded = memo(record)
+    assert [unbounded('1 2'), unbounded(1, 2), unbounded(1, 2), unbounded(1, b=2)] == [1, 2, 2, 3]
+    assert unbounded.cache_info() == CacheInfo(1, 3, None, 3)
+    lru = memo(maxsize=2)(record)
+    for number in [1, 2, 1, 3]:
+        lru(number)
+    assert lru.cache_info() == CacheInfo(1, 3, 2, 2)
+    lru(1)
+    assert lru.cache_info().hits == 2
+    lru(2)
+    assert lru.cache_info().misses == 4
+    # memos of the same function keep separate attributes
+    assert unbounded.cache_info().maxsize is None and not hasattr(record, 'cache_info')
+    unbounded.cache_clear()
+    assert unbounded.cache_info().currsize == 0 and lru.cache_info().currsize == 2
+
+    now = [0]
+    expiring = memo(ttl=10, clock=lambda: now[0])(record)
+    first = expiring(1)
+    now[0] = 9
+    assert expiring(1) == first
+    now[0] = 10
+    assert expiring(1) != first
+    assert expiring.cache_info() == CacheInfo(1, 2, None, 1)
+    expiring.cache_clear()
+    assert expiring.cache_info() == CacheInfo(0, 0, None, 0)
+    print 'OK'
+
+
+def run_threads(target, number):
+    '''Run target in number threads, return what each returned or raised.'''
+    results = []
+
+    def run():
+        try:
+            results.append(target())
+        except Exception as error:
+            results.append(error)
+
+    threads = [threading.Thread(target=run) for _ in range(number)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def test_concurrent_memo():
+    print "test_concurrent_memo..."
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    @concurrent_memo
+    def slow(x):
+        calls.append(x)
+        started.set()
+        release.wait()
+        if x < 0:
+            raise ValueError(x)
+        return x * 2
+
+    # the first caller computes, everyone else waits for it or hits the cache
+    leader, results = run_threads(lambda: slow(21), 1)
+    started.wait()
+    waiters, _ = run_threads(lambda: slow(21), 7)
+    time.sleep(0.05)
+    release.set()
+    for thread in leader + waiters:
+        thread.join()
+    assert calls == [21] and results == [42]
+    assert slow.cache_info() == CacheInfo(7, 1, None, 1)
+
+    # an exception reaches every waiter and is not cached
+    started.clear()
+    release.clear()
+    threads, results = run_threads(lambda: slow(-1), 1)
+    started.wait()
+    waiters, errors = run_threads(lambda: slow(-1), 7)
+    time.sleep(0.05)
+    release.set()
+    for thread in threads + waiters:
+        thread.join()
+    assert len(results + errors) == 8 and all(isinstance(error, ValueError) for error in results + errors)
+    assert calls.count(-1) >= 1 and slow.cache_info().currsize == 1
+    try:
+        slow(-1)
+        assert False
+    except ValueError:
+        pass
+    assert calls.count(-1) >= 2
+
+    @concurrent_memo
+    def itself(x):
+        return itself(x)
+    try:
+        itself(1)
+        assert False
+    except RuntimeError:
+        pass
+    print 'OK'
+
+
+def test_profile():
+    global timer
+    print "test_profile..."
+    if not PROFILE_ENABLED:
+        print 'skipped, DECO_PROFILE=0'
+        return
+    now = [0.0]
+    saved, timer = timer, lambda: now[0]
+    try:
+        def raw():
+            now[0] += 0.002
+        inner = profile(raw)
+
+        @profile
+        def outer(n):
+            now[0] += 0.001
+            inner()
+            if n:
+                outer(n - 1)
+
+        outer(1)
+    finally:
+        timer = saved
+    try:
+        assert inner.profile in PROFILES and outer.profile in PROFILES
+        assert inner.__name__ == 'raw' and not hasattr(raw, 'profile')
+
+        # total counts the outermost call only, self time excludes profiled callees
+        close = lambda a, b: abs(a - b) < 1e-9
+        assert outer.profile.calls == inner.profile.calls == 2
+        assert close(outer.profile.total, 0.006) and close(outer.profile.own, 0.002)
+        assert close(inner.profile.total, 0.004) and close(inner.profile.own, 0.004)
+
+        names = [line.split()[0] for line in profile_report('total').splitlines()[1:]]
+        assert names.index(outer.profile.name) < names.index(inner.profile.name)
+        names = [line.split()[0] for line in profile_report('self').splitlines()[1:]]
+        assert names.index(inner.profile.name) < names.index(outer.profile.name)
+        assert profile_report().splitlines()[0].split()[0] == 'function'
+
+        stats = dict((entry['name'], entry) for entry in json.loads(profile_json()))
+        assert stats[inner.profile.name]['histogram'] == [{'lt_us': 2048, 'count': 2}]
+        assert [bucket['lt_us'] for bucket in stats[outer.profile.name]['histogram']] == [4096, 8192]
+
+        profile_reset()
+        assert (outer.profile.calls, outer.profile.total, inner.profile.histogram) == \
+            (0, 0.0, [0] * HISTOGRAM_BUCKETS)
+    finally:
+        PROFILES.remove(inner.profile)
+        PROFILES.remove(outer.profile)
+
+    # each wrapper counts its own calls
+    def plain():
+        pass
+    first, second = countcalls(plain), countcalls(plain)
+    first()
+    first()
+    second()
+    assert (first.calls, second.calls) == (2, 1) and not hasattr(plain, 'calls')
+    print 'OK'
+
+
+def test_ring_trace():
+    global timer
+    print "test_ring_trace..."
+    ticks = itertools.count(1)
+    saved, timer = timer, lambda: next(ticks) * 0.001
+    try:
+        ring = TraceBuffer(4)
+
+        def raw(n):
+            return n if n == 0 else countdown(n - 1)
+        countdown = ring_trace(raw, buffer=ring)
+        assert countdown(2) == 0
+        assert countdown.__name__ == 'raw' and not raw.__dict__
+
+        # six events in four slots: both outer enters are overwritten
+        assert ring.written == 6 and ring.dropped() == 2
+        assert [(event[0], event[2]) for event in ring] == [('B', (0,)), ('E', (0,)), ('E', (1,)), ('E', (2,))]
+        assert render_trace(ring, '##') == '\n'.join([
+            enter_line('##', 2, 'raw(0)'), exit_line('##', 2, 'raw(0)', 0)])
+
+        # an exception is the result of the exit event
+        errors = TraceBuffer(8)
+
+        @ring_trace(buffer=errors)
+        def fail():
+            raise ValueError('boom')
+        try:
+            fail()
+            assert False
+        except ValueError:
+            pass
+        begin, end = list(errors)
+        assert begin[0] == 'B' and end[0] == 'E' and isinstance(end[3], ValueError)
+        trace = json.loads(chrome_trace(errors))
+        assert trace['displayTimeUnit'] == 'ms'
+        assert [(event['name'], event['ph'], event['args']) for event in trace['traceEvents']] == [
+            ('fail', 'B', {'args': ''}), ('fail', 'E', {'result': repr(ValueError('boom'))})]
+        assert all(event['pid'] == os.getpid() and event['tid'] == get_ident() for event in trace['traceEvents'])
+        assert [event['ts'] for event in trace['traceEvents']] == [begin[5] * 1e6, end[5] * 1e6]
+        assert begin[5] < end[5]
+
+        # sample=0 records nothing, sample=1 everything
+        never = TraceBuffer(8)
+        assert ring_trace(lambda: 1, buffer=never, sample=0)() == 1 and never.written == 0
+        ring_trace(lambda: 1, buffer=never, sample=1)()
+        assert never.written == 2
+
+        # an empty selection is not the global buffer
+        assert render_trace([]) == ''
+        assert json.loads(chrome_trace([]))['traceEvents'] == []
+    finally:
+        timer = saved
+    print 'OK'
+
+
+def square(x):
+    return x * x
+
+
+def pooled_square(args):
+    path, x = args
+    return persistent_memo(square, path=path)(x)
+
+
+def test_persistent_memo():
+    print "test_persistent_memo..."
+    import multiprocessing
+    import shutil
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'memo.sqlite')
+
+        # results computed in other processes are hits here
+        pool = multiprocessing.Pool(4)
+        assert pool.map(pooled_square, [(path, x) for x in range(8)]) == [x * x for x in range(8)]
+        pool.close()
+        pool.join()
+        cached = persistent_memo(square, path=path)
+        assert [cached(x) for x in range(8)] == [x * x for x in range(8)]
+        assert cached.cache_info() == CacheInfo(8, 0, 100000, 8)
+        assert cached.__name__ == 'square'
+
+        # another version misses and is counted apart
+        other = persistent_memo(square, path=path, version='2')
+        assert other(3) == 9
+        assert other.cache_info() == CacheInfo(0, 1, 100000, 1)
+        other.cache_clear()
+        assert other.cache_info().currsize == cached.cache_info().currsize == 0
+
+        # least recently used rows go first
+        now = [0.0]
+        store = SqliteStore(os.path.join(directory, 'small.sqlite'), maxsize=4, touch_interval=0,
+                            clock=lambda: now[0])
+        for key in 'abcd':
+            now[0] += 1
+            store.set(key, 'f', 'v', key.upper())
+        now[0] += 1
+        assert store.get('a') == (True, 'A')
+        now[0] += 1
+        store.set('e', 'f', 'v', 'E')
+        assert store.get('b') == (False, None)
+        assert [store.get(key)[0] for key in 'acde'] == [True] * 4
+        assert store.count('f', 'v') == 4
+
+        # a file of another user is never unpickled
+        if os.getuid() == 0:
+            # another maxsize gets a new store, which checks on connect
+            os.chown(path, 65534, 65534)
+            try:
+                persistent_memo(square, path=path, maxsize=1)(2)
+                assert False
+            except IOError:
+                pass
+    finally:
+        shutil.rmtree(directory)
+    print 'OK'
 
 
 if __name__ == '__main__':
     main()
+    test_memo()
+    test_concurrent_memo()
+    test_persistent_memo()
+    test_profile()
+    test_ring_trace()
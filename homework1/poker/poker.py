@@ -27,6 +27,15 @@
 # Можно свободно определять свои функции и т.п.
 # -----------------
 
+import mmap
+import os
+import random
+import struct
+from string import maketrans
+import threading
+from collections import OrderedDict, namedtuple
+from itertools import combinations, combinations_with_replacement, permutations
+
 
 class JokerIterator:
 
@@ -54,15 +63,7 @@ class JokerIterator:
         return iter(cards)
 
     def create_card(self, rank, suit):
-        correct_rank = ''
-        if rank in Card.RANKS_NUMERICAL.values():
-            for rank_symbolic, rank_numerical in Card.RANKS_NUMERICAL.iteritems():
-                if rank == rank_numerical:
-                    correct_rank = rank_symbolic
-                    break
-        else:
-            correct_rank = str(rank)
-        return correct_rank + suit
+        return RANK_SYMBOLS[rank - Card.MIN_RANK] + suit
 
 
 class HandIterator:
@@ -98,20 +99,23 @@ class HandIterator:
 
 
 class Hand:
-    """ Класс для работы с рукой карт. """
-    cards = []
+    """ Класс для работы с рукой карт. Карты хранятся битовой маской (см. hand_mask) """
+    mask = 0
 
     CARDS_NUMBER_IN_HAND = 7
     CARDS_NUMBER_IN_COMBINATION = 5
 
     def __init__(self, card_strings):
-        self.cards = list(map(lambda card_str: Card(card_str), card_strings))
+        self.mask = hand_mask(card_strings)
 
     def get_ranks(self):
-        return sorted(list(map(lambda card: card.rank, self.cards)))
+        return sorted(rank_index + Card.MIN_RANK
+                      for suit_index in range(len(SUIT_SYMBOLS))
+                      for rank_index in mask_bits(suit_mask(self.mask, suit_index)))
 
     def get_suits(self):
-        return sorted(list(map(lambda card: card.suit, self.cards)))
+        return sorted(suit for suit_index, suit in enumerate(SUIT_SYMBOLS)
+                      for _ in mask_bits(suit_mask(self.mask, suit_index)))
 
 
 class Card:
@@ -144,8 +148,8 @@ class Card:
 
     def get_rank(self, card):
         rank = card[self.RANK_INDEX_IN_CARD]
-        if rank in self.RANKS_NUMERICAL:
-            return self.RANKS_NUMERICAL[rank]
+        if rank in RANK_VALUES:
+            return RANK_VALUES[rank]
         return int(rank)
 
     def is_correct(self):
@@ -157,14 +161,18 @@ class Card:
 
 def hand_rank(hand):
     """Возвращает значение определяющее ранг 'руки'"""
-    ranks = card_ranks(hand)
-    if straight(ranks) and flush(hand):
+    return mask_rank(hand.mask)
+
+
+def ranks_rank(ranks, is_flush):
+    """Ранг 'руки' по отсортированным рангам карт и признаку флеша"""
+    if straight(ranks) and is_flush:
         return (8, max(ranks))
     elif kind(4, ranks):
         return (7, kind(4, ranks), kind(1, ranks))
     elif kind(3, ranks) and kind(2, ranks):
         return (6, kind(3, ranks), kind(2, ranks))
-    elif flush(hand):
+    elif is_flush:
         return (5, ranks)
     elif straight(ranks):
         return (4, max(ranks))
@@ -181,17 +189,18 @@ def hand_rank(hand):
 def card_ranks(hand):
     """Возвращает список рангов (его числовой эквивалент),
     отсортированный от большего к меньшему"""
-    return sorted(hand.get_ranks())
+    return sorted_ranks(hand.get_ranks())
+
+
+def sorted_ranks(ranks):
+    """Сортирует ранги по убыванию, туз в стрите до пятерки считается единицей"""
+    ranks = sorted(ranks, reverse=True)
+    return [5, 4, 3, 2, 1] if ranks == [14, 5, 4, 3, 2] else ranks
 
 
 def flush(hand):
     """Возвращает True, если все карты одной масти"""
-    suits = hand.get_suits()
-    first_suit = suits[0]
-    for suit in suits[1:]:
-        if suit != first_suit:
-            return False
-    return True
+    return mask_is_flush(hand.mask)
 
 
 def straight(ranks):
@@ -232,6 +241,289 @@ def two_pair(ranks):
     return None
 
 
+# -----------------
+# Быстрый вычислитель силы руки.
+# Карта кодируется целым числом (как у Cactus Kev):
+#   биты 16-28 - бит ранга, биты 12-15 - бит масти,
+#   биты 8-11 - номер ранга, биты 0-7 - простое число ранга.
+# Сила руки - одно целое число, чем больше, тем сильнее рука.
+# Порядок сил полностью совпадает с порядком значений hand_rank.
+# -----------------
+
+RANK_SYMBOLS = '23456789TJQKA'
+SUIT_SYMBOLS = 'CSHD'
+RANK_PRIMES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+SUIT_MASK = 0xF000
+PRIME_MASK = 0xFF
+RANK_BITS_SHIFT = 16
+
+
+def make_card_code(rank_index, suit_index):
+    return ((1 << rank_index) << RANK_BITS_SHIFT) | ((1 << suit_index) << 12) | (rank_index << 8) | \
+        RANK_PRIMES[rank_index]
+
+
+CARD_CODES = dict((rank + suit, make_card_code(rank_index, suit_index))
+                  for rank_index, rank in enumerate(RANK_SYMBOLS)
+                  for suit_index, suit in enumerate(SUIT_SYMBOLS))
+CARD_STRINGS = dict((code, card) for card, code in CARD_CODES.items())
+
+
+def encode_card(card):
+    """Строка карты ('TH') -> целочисленный код"""
+    try:
+        return CARD_CODES[card]
+    except KeyError:
+        raise Exception('Incorrect card format')
+
+
+def build_strength_tables():
+    """Строит таблицы сил: для флешей и пяти разных рангов индекс - битовая
+    маска рангов, для рук с повторами рангов ключ - произведение простых чисел"""
+    keys = {}
+    for indices in combinations(range(13), 5):
+        ranks = sorted_ranks([i + 2 for i in indices])
+        mask = sum(1 << i for i in indices)
+        keys[('flush', mask)] = ranks_rank(ranks, True)
+        keys[('unique', mask)] = ranks_rank(ranks, False)
+    for indices in combinations_with_replacement(range(13), 5):
+        if len(set(indices)) == 5 or max(indices.count(i) for i in indices) > 4:
+            continue
+        product = 1
+        for i in indices:
+            product *= RANK_PRIMES[i]
+        keys[('paired', product)] = ranks_rank(sorted_ranks([i + 2 for i in indices]), False)
+    frozen = dict((table_key, freeze(rank)) for table_key, rank in keys.items())
+    strengths = dict((key, strength) for strength, key in enumerate(sorted(set(frozen.values())), 1))
+    flushes = [0] * (1 << 13)
+    unique = [0] * (1 << 13)
+    paired = {}
+    ranks = {}
+    for (kind_of_table, index), rank in keys.items():
+        strength = strengths[frozen[kind_of_table, index]]
+        ranks[strength] = rank
+        if kind_of_table == 'flush':
+            flushes[index] = strength
+        elif kind_of_table == 'unique':
+            unique[index] = strength
+        else:
+            paired[index] = strength
+    return flushes, unique, paired, ranks
+
+
+def freeze(rank):
+    """Значение hand_rank -> хешируемый кортеж с тем же порядком"""
+    return tuple(tuple(value) if isinstance(value, list) else value for value in rank)
+
+
+FLUSH_STRENGTH, UNIQUE_STRENGTH, PAIRED_STRENGTH, STRENGTH_RANKS = build_strength_tables()
+
+
+def evaluate5(c0, c1, c2, c3, c4):
+    """Сила руки из пяти закодированных карт"""
+    if c0 & c1 & c2 & c3 & c4 & SUIT_MASK:
+        return FLUSH_STRENGTH[(c0 | c1 | c2 | c3 | c4) >> RANK_BITS_SHIFT]
+    strength = UNIQUE_STRENGTH[(c0 | c1 | c2 | c3 | c4) >> RANK_BITS_SHIFT]
+    if strength:
+        return strength
+    return PAIRED_STRENGTH[(c0 & PRIME_MASK) * (c1 & PRIME_MASK) * (c2 & PRIME_MASK) *
+                           (c3 & PRIME_MASK) * (c4 & PRIME_MASK)]
+
+
+def strength_to_rank(strength):
+    """Сила руки -> значение в формате hand_rank"""
+    return STRENGTH_RANKS[strength]
+
+
+def best_combination(codes):
+    """Лучшая пятерка из закодированных карт: (сила, пятерка кодов).
+    При равной силе остается первая пятерка в порядке перебора, как в HandIterator"""
+    best_strength, best_codes = 0, None
+    for five in combinations(codes, 5):
+        c0, c1, c2, c3, c4 = five
+        if c0 & c1 & c2 & c3 & c4 & SUIT_MASK:
+            strength = FLUSH_STRENGTH[(c0 | c1 | c2 | c3 | c4) >> RANK_BITS_SHIFT]
+        else:
+            strength = UNIQUE_STRENGTH[(c0 | c1 | c2 | c3 | c4) >> RANK_BITS_SHIFT] or \
+                PAIRED_STRENGTH[(c0 & PRIME_MASK) * (c1 & PRIME_MASK) * (c2 & PRIME_MASK) *
+                                (c3 & PRIME_MASK) * (c4 & PRIME_MASK)]
+        if strength > best_strength:
+            best_strength, best_codes = strength, five
+    return best_strength, best_codes
+
+
+# -----------------
+# Битовые маски.
+# Рука - целое число из 52 бит: по 13 бит на масть (в порядке SUIT_SYMBOLS),
+# внутри масти бит номер ранга. Строки разбираются только на входе (hand_mask),
+# флеш, стрит и повторы рангов определяются битовыми операциями.
+# -----------------
+
+SUIT_BITS = len(RANK_SYMBOLS)
+SUIT_BITS_MASK = (1 << SUIT_BITS) - 1
+WHEEL_RANKS_MASK = 0b1000000001111
+RANK_VALUES = dict((rank, rank_index + 2) for rank_index, rank in enumerate(RANK_SYMBOLS))
+CARD_BITS = dict((rank + suit, 1 << (suit_index * SUIT_BITS + rank_index))
+                 for rank_index, rank in enumerate(RANK_SYMBOLS)
+                 for suit_index, suit in enumerate(SUIT_SYMBOLS))
+POPCOUNT = [bin(i).count('1') for i in range(1 << SUIT_BITS)]
+
+
+def hand_mask(cards):
+    """Строки карт -> битовая маска руки"""
+    mask = 0
+    for card in cards:
+        try:
+            mask |= CARD_BITS[card]
+        except KeyError:
+            raise Exception('Incorrect card format')
+    return mask
+
+
+def card_bit(rank_index, suit_index):
+    return 1 << (suit_index * SUIT_BITS + rank_index)
+
+
+# бит карты по паре (ранг, масть)
+PAIR_BITS = dict(((rank_index, suit_index), card_bit(rank_index, suit_index))
+                 for rank_index in range(len(RANK_SYMBOLS)) for suit_index in range(len(SUIT_SYMBOLS)))
+
+
+def suit_mask(mask, suit_index):
+    """13 бит рангов одной масти"""
+    return (mask >> (suit_index * SUIT_BITS)) & SUIT_BITS_MASK
+
+
+def mask_bits(ranks_mask):
+    """Номера установленных бит по убыванию"""
+    bits = []
+    while ranks_mask:
+        bit = ranks_mask.bit_length() - 1
+        bits.append(bit)
+        ranks_mask ^= 1 << bit
+    return bits
+
+
+def mask_is_flush(mask):
+    """Все карты одной масти"""
+    return sum(1 for suit_index in range(len(SUIT_SYMBOLS)) if suit_mask(mask, suit_index)) == 1
+
+
+def straight_top(ranks_mask):
+    """Старший ранг лучшего стрита по маске рангов или None, туз может быть единицей"""
+    extended = (ranks_mask << 1) | (ranks_mask >> (SUIT_BITS - 1))
+    runs = extended & (extended >> 1) & (extended >> 2) & (extended >> 3) & (extended >> 4)
+    if not runs:
+        return None
+    return runs.bit_length() + 4
+
+
+def kind_masks(mask):
+    """Маски рангов, встречающихся хотя бы 1, 2, 3 и 4 раза"""
+    c, s, h, d = [suit_mask(mask, suit_index) for suit_index in range(len(SUIT_SYMBOLS))]
+    return (c | s | h | d,
+            (c & s) | (c & h) | (c & d) | (s & h) | (s & d) | (h & d),
+            (c & s & h) | (c & s & d) | (c & h & d) | (s & h & d),
+            c & s & h & d)
+
+
+def mask_rank(mask):
+    """hand_rank для маски из пяти карт"""
+    ones, twos, threes, fours = kind_masks(mask)
+    if ones == WHEEL_RANKS_MASK and POPCOUNT[ones] == 5:
+        ranks = [5, 4, 3, 2, 1]
+    else:
+        ranks = []
+        for bit in mask_bits(ones):
+            count = 1 + (twos >> bit & 1) + (threes >> bit & 1) + (fours >> bit & 1)
+            ranks.extend([bit + 2] * count)
+    is_flush = mask_is_flush(mask)
+    top = straight_top(ones) if POPCOUNT[ones] == 5 else None
+    pairs = twos & ~threes
+    if top and is_flush:
+        return (8, top)
+    elif fours:
+        return (7, fours.bit_length() + 1, (ones & ~fours).bit_length() + 1)
+    elif threes and pairs:
+        return (6, threes.bit_length() + 1, pairs.bit_length() + 1)
+    elif is_flush:
+        return (5, ranks)
+    elif top:
+        return (4, top)
+    elif threes:
+        return (3, threes.bit_length() + 1, ranks)
+    elif POPCOUNT[pairs] >= 2:
+        high = pairs.bit_length() - 1
+        return (2, (high + 2, (pairs ^ (1 << high)).bit_length() + 1), ranks)
+    elif pairs:
+        return (1, pairs.bit_length() + 1, ranks)
+    else:
+        return (0, ranks)
+
+
+# -----------------
+# Необязательная таблица состояний для 7ми карт (см. poker_table.py).
+# Рука из 7ми карт оценивается семью переходами по таблице, лучшая
+# пятерка затем ищется среди сочетаний с найденной силой.
+# Если файла нет или его версия не совпадает, используется best_combination.
+# -----------------
+
+SEVEN_CARD_TABLE_MAGIC = 'PK7T'
+SEVEN_CARD_TABLE_VERSION = 1
+SEVEN_CARD_TABLE_HEADER = '<4sII'
+SEVEN_CARD_TABLE_DATA_OFFSET = struct.calcsize(SEVEN_CARD_TABLE_HEADER)
+SEVEN_CARD_TABLE_PATH = os.environ.get(
+    'POKER_TABLE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'poker_table.bin'))
+
+# номер карты в таблице: ранг * 4 + масть + 1
+CARD_NUMBERS = dict((card, RANK_SYMBOLS.index(card[0]) * 4 + SUIT_SYMBOLS.index(card[1]) + 1)
+                    for card in CARD_CODES)
+
+
+def load_seven_card_table(path=SEVEN_CARD_TABLE_PATH):
+    """Отображает файл таблицы в память, None - если таблицы нет или она не подходит"""
+    try:
+        with open(path, 'rb') as f:
+            table = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return None
+    if len(table) < SEVEN_CARD_TABLE_DATA_OFFSET:
+        table.close()
+        return None
+    magic, version, entries = struct.unpack_from(SEVEN_CARD_TABLE_HEADER, table, 0)
+    if magic != SEVEN_CARD_TABLE_MAGIC or version != SEVEN_CARD_TABLE_VERSION or \
+            len(table) != SEVEN_CARD_TABLE_DATA_OFFSET + entries * 4:
+        table.close()
+        return None
+    return table
+
+
+SEVEN_CARD_TABLE = load_seven_card_table()
+
+
+def evaluate7(hand, table=None):
+    """Сила руки из 7ми карт по таблице состояний"""
+    table = table or SEVEN_CARD_TABLE
+    unpack_from = struct.unpack_from
+    position = 0
+    for card in hand:
+        position = unpack_from('<i', table, SEVEN_CARD_TABLE_DATA_OFFSET + 4 * (position + CARD_NUMBERS[card]))[0]
+    return position
+
+
+def recover_best_five(codes, strength):
+    """Первая в порядке перебора пятерка с заданной силой"""
+    for five in combinations(codes, 5):
+        c0, c1, c2, c3, c4 = five
+        if c0 & c1 & c2 & c3 & c4 & SUIT_MASK:
+            if FLUSH_STRENGTH[(c0 | c1 | c2 | c3 | c4) >> RANK_BITS_SHIFT] == strength:
+                return five
+        elif (UNIQUE_STRENGTH[(c0 | c1 | c2 | c3 | c4) >> RANK_BITS_SHIFT] or
+              PAIRED_STRENGTH[(c0 & PRIME_MASK) * (c1 & PRIME_MASK) * (c2 & PRIME_MASK) *
+                              (c3 & PRIME_MASK) * (c4 & PRIME_MASK)]) == strength:
+            return five
+
+
 def count_best_combination_rank(hand):
     hand_iterator = HandIterator(hand)
     best_comination = []
@@ -247,6 +539,30 @@ def count_best_combination_rank(hand):
 
 def best_hand(hand):
     """Из "руки" в 7 карт возвращает лучшую "руку" в 5 карт """
+    return compute_best_hand(hand)
+
+
+def cached_best_hand(hand):
+    """best_hand через кеш с точностью до перестановки мастей"""
+    key, suits = canonical_hand(hand)
+    five = BEST_HAND_CACHE.get(key)
+    if five is None:
+        five = BEST_HAND_CACHE.put(key, tuple(compute_best_hand(canonical_cards(hand, suits))))
+    return sorted(translate_suits(five, suits), key=hand.index)
+
+
+def compute_best_hand(hand):
+    """best_hand без кеша"""
+    codes = [encode_card(card) for card in hand]
+    if SEVEN_CARD_TABLE is not None and len(codes) == 7 and len(set(codes)) == 7:
+        codes = recover_best_five(codes, evaluate7(hand))
+    else:
+        _, codes = best_combination(codes)
+    return [CARD_STRINGS[code] for code in codes]
+
+
+def reference_best_hand(hand):
+    """Исходная реализация best_hand через hand_rank, для сверки"""
     best_comination, _ = count_best_combination_rank(hand)
     return best_comination
 
@@ -275,20 +591,356 @@ def transform_wild_to_simple(hands):
     return new_hands
 
 
+# -----------------
+# Разбор джокеров без перебора замен.
+# Категории проверяются сверху вниз (стрит-флеш, каре, фулл-хаус, ...),
+# и для каждой категории ранги перебираются по убыванию. Джокер закрывает
+# недостающую карту, если ее масть подходит по цвету и такой карты еще нет
+# в руке. Первая найденная категория и есть лучшая; внутри нее выбирается
+# вариант с наибольшей силой.
+# -----------------
+
+JOKER_SUITS = dict((JokerIterator.JOKER_SYMBOL + color, tuple(SUIT_SYMBOLS.index(suit) for suit in suits))
+                   for color, suits in JokerIterator.TYPE_OF_CARD.items())
+ACE = len(RANK_SYMBOLS) - 1
+# окна стритов от старшего к младшему, последнее - стрит от туза до пятерки
+STRAIGHT_WINDOWS = [tuple(range(top - 4, top + 1)) for top in range(ACE, 3, -1)] + [(ACE, 0, 1, 2, 3)]
+
+
+def place_jokers(jokers, slots, taken):
+    """Все способы закрыть слоты джокерами. Слот - список подходящих карт (ранг, масть).
+    taken - маска занятых карт.
+    Возвращает пары: [(позиция джокера, карта)] и неиспользованные джокеры"""
+    if not slots:
+        yield [], jokers
+        return
+    for i, (position, suits) in enumerate(jokers):
+        rest = jokers[:i] + jokers[i + 1:]
+        for card in slots[0]:
+            bit = PAIR_BITS[card]
+            if card[1] in suits and not taken & bit:
+                for placed, left in place_jokers(rest, slots[1:], taken | bit):
+                    yield [(position, card)] + placed, left
+
+
+class WildHand:
+    """ Рука с джокерами: обычные карты как (ранг, масть) и масти, доступные джокерам """
+
+    def __init__(self, hand):
+        self.hand = hand
+        self.cards = {}
+        self.jokers = []
+        for position, card in enumerate(hand):
+            if card in JOKER_SUITS:
+                self.jokers.append((position, JOKER_SUITS[card]))
+            else:
+                encode_card(card)
+                self.cards[position] = (RANK_SYMBOLS.index(card[0]), SUIT_SYMBOLS.index(card[1]))
+        self.present = 0
+        for rank, suit in self.cards.values():
+            self.present |= card_bit(rank, suit)
+        self.positions_by_rank = [[] for _ in RANK_SYMBOLS]
+        for position in sorted(self.cards):
+            self.positions_by_rank[self.cards[position][0]].append(position)
+
+    def best(self):
+        """Лучшая пятерка: (сила, [(позиция, карта)])"""
+        for search in (self.straight_flush, self.four_of_a_kind, self.full_house, self.flush,
+                       self.straight, self.three_of_a_kind, self.two_pair, self.pair, self.high_card):
+            result = search()
+            if result is not None:
+                return result
+
+    def strings(self, cards):
+        return [RANK_SYMBOLS[rank] + SUIT_SYMBOLS[suit] for _, (rank, suit) in sorted(cards)]
+
+    def complete(self, used, slots, kickers_number):
+        """Закрывает слоты джокерами и добирает старшие кикеры из оставшихся карт"""
+        best = None
+        if len(slots) > len(self.jokers):
+            return None
+        for placed, left in place_jokers(self.jokers, slots, self.present):
+            cards = [(position, self.cards[position]) for position in used] + placed
+            taken = self.present
+            for _, card in placed:
+                taken |= PAIR_BITS[card]
+            kickers = [(card, position) for position, card in self.cards.items() if position not in used]
+            for position, suits in left:
+                card = max((((SUIT_BITS_MASK & ~suit_mask(taken, suit)).bit_length() - 1, suit)
+                            for suit in suits))
+                taken |= card_bit(*card)
+                kickers.append((card, position))
+            kickers.sort(key=lambda kicker: kicker[0][0], reverse=True)
+            cards.extend((position, card) for card, position in kickers[:kickers_number])
+            strength = evaluate5(*[make_card_code(rank, suit) for _, (rank, suit) in cards])
+            if best is None or strength > best[0]:
+                best = (strength, cards)
+        return best
+
+    def groups(self, groups, kickers_number):
+        """Карты одного ранга: groups - список (ранг, сколько карт нужно)"""
+        missing = 0
+        for rank, size in groups:
+            missing += max(0, size - len(self.positions_by_rank[rank]))
+        if missing > len(self.jokers):
+            return None
+        used, slots = [], []
+        for rank, size in groups:
+            positions = self.positions_by_rank[rank][:size]
+            used.extend(positions)
+            slots.extend([[(rank, suit) for suit in range(len(SUIT_SYMBOLS))]] * (size - len(positions)))
+        return self.complete(used, slots, kickers_number)
+
+    def straight_flush(self):
+        for window in STRAIGHT_WINDOWS:
+            results = []
+            for suit in range(len(SUIT_SYMBOLS)):
+                used = [position for position, card in self.cards.items() if card[1] == suit and card[0] in window]
+                slots = [[(rank, suit)] for rank in window if not self.present & card_bit(rank, suit)]
+                result = self.complete(used, slots, 0)
+                if result is not None:
+                    results.append(result)
+            if results:
+                return max(results)
+
+    def four_of_a_kind(self):
+        for rank in range(ACE, -1, -1):
+            result = self.groups([(rank, 4)], 1)
+            if result is not None:
+                return result
+
+    def full_house(self):
+        for three in range(ACE, -1, -1):
+            if len(self.positions_by_rank[three]) + len(self.jokers) < 3:
+                continue
+            for two in range(ACE, -1, -1):
+                if two != three:
+                    result = self.groups([(three, 3), (two, 2)], 0)
+                    if result is not None:
+                        return result
+
+    def flush(self):
+        best = None
+        for suit in range(len(SUIT_SYMBOLS)):
+            cards = [(position, card) for position, card in self.cards.items() if card[1] == suit]
+            ranks = suit_mask(self.present, suit)
+            for position, suits in self.jokers:
+                if suit in suits:
+                    rank = (SUIT_BITS_MASK & ~ranks).bit_length() - 1
+                    ranks |= 1 << rank
+                    cards.append((position, (rank, suit)))
+            if len(cards) >= 5:
+                cards.sort(key=lambda item: item[1][0], reverse=True)
+                cards = cards[:5]
+                result = (evaluate5(*[make_card_code(rank, suit) for _, (rank, suit) in cards]), cards)
+                best = max(best, result)
+        return best
+
+    def straight(self):
+        for window in STRAIGHT_WINDOWS:
+            result = self.groups([(rank, 1) for rank in window], 0)
+            if result is not None:
+                return result
+
+    def three_of_a_kind(self):
+        for rank in range(ACE, -1, -1):
+            result = self.groups([(rank, 3)], 2)
+            if result is not None:
+                return result
+
+    def two_pair(self):
+        for high in range(ACE, -1, -1):
+            for low in range(high - 1, -1, -1):
+                result = self.groups([(high, 2), (low, 2)], 1)
+                if result is not None:
+                    return result
+
+    def pair(self):
+        for rank in range(ACE, -1, -1):
+            result = self.groups([(rank, 2)], 3)
+            if result is not None:
+                return result
+
+    def high_card(self):
+        return self.complete([], [], 5)
+
+
 def best_wild_hand(hand):
+    """Из "руки" в 7 карт с джокерами возвращает лучшую "руку" в 5 карт"""
+    return compute_best_wild_hand(hand)
+
+
+def cached_best_wild_hand(hand):
+    """best_wild_hand через кеш с точностью до перестановки мастей"""
+    if not any(card in JOKER_SUITS for card in hand):
+        return cached_best_hand(hand)
+    key, suits = canonical_wild_hand(hand)
+    five = BEST_WILD_HAND_CACHE.get(key)
+    if five is None:
+        five = BEST_WILD_HAND_CACHE.put(key, tuple(compute_best_wild_hand(canonical_wild_cards(key))))
+    return restore_wild_cards(five, suits, hand)
+
+
+def compute_best_wild_hand(hand):
+    """best_wild_hand без кеша"""
+    wild_hand = WildHand(hand)
+    if not wild_hand.jokers:
+        return compute_best_hand(hand)
+    _, cards = wild_hand.best()
+    return wild_hand.strings(cards)
+
+
+def reference_best_wild_hand(hand):
+    """Исходная реализация best_wild_hand через перебор замен джокеров, для сверки"""
     hands = transform_wild_to_simple([hand])
     best_comination = []
     max_rank = 0
     for hand in hands:
-        # print(hand)
         curr_combination, curr_rank = count_best_combination_rank(hand)
-        # print(curr_combination)
         if curr_rank > max_rank:
             max_rank = curr_rank
             best_comination = curr_combination
     return best_comination
 
 
+# -----------------
+# Кеш лучших рук с точностью до перестановки мастей.
+# Рука приводится к канонической: масти упорядочиваются по маскам рангов,
+# так что руки, отличающиеся только мастями (и порядком карт), получают
+# один ключ. Лучшая пятерка считается для канонической руки и запоминается,
+# на выходе масти переводятся обратно, а карты идут в порядке исходной руки.
+# Кеш включается явно (cached_best_hand, cached_best_wild_hand): случайные
+# руки в 7 карт почти не повторяются, и на промахе канонизация стоит
+# дороже самого вычисления, поэтому best_hand и best_wild_hand его не берут.
+# Для рук с джокерами допустимы только перестановки, сохраняющие цвета:
+# трефы и пики остаются черными (?B), червы и бубны - красными (?R),
+# при этом черные и красные масти могут поменяться местами целиком.
+# -----------------
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+
+class BoundedCache:
+    """ Ограниченный кеш: при переполнении вытесняются самые старые ключи.
+    Чтение не берет блокировку и не меняет порядок, чтобы попадание стоило
+    одного обращения к словарю """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.items.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+        return value
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.items))
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.hits = self.misses = 0
+
+
+BEST_HAND_CACHE = BoundedCache(100000)
+BEST_WILD_HAND_CACHE = BoundedCache(100000)
+
+
+def cache_info():
+    """Статистика кешей cached_best_hand и cached_best_wild_hand"""
+    return {'best_hand': BEST_HAND_CACHE.info(), 'best_wild_hand': BEST_WILD_HAND_CACHE.info()}
+
+
+def cache_clear():
+    BEST_HAND_CACHE.clear()
+    BEST_WILD_HAND_CACHE.clear()
+
+
+def canonical_hand(hand):
+    """Ключ класса руки (маски мастей по убыванию) и исходные масти
+    в порядке канонических"""
+    mask = hand_mask(hand)
+    masks = [(mask & SUIT_BITS_MASK, 0), ((mask >> SUIT_BITS) & SUIT_BITS_MASK, 1),
+             ((mask >> 2 * SUIT_BITS) & SUIT_BITS_MASK, 2), (mask >> 3 * SUIT_BITS, 3)]
+    masks.sort(reverse=True)
+    return ((masks[0][0], masks[1][0], masks[2][0], masks[3][0]),
+            (masks[0][1], masks[1][1], masks[2][1], masks[3][1]))
+
+
+# таблицы str.translate для каждой перестановки мастей: исходные -> канонические и обратно
+SUIT_PERMUTATIONS = dict((suits, ''.join(SUIT_SYMBOLS[suit_index] for suit_index in suits))
+                         for suits in permutations(range(len(SUIT_SYMBOLS))))
+TO_CANONICAL_SUITS = dict((suits, maketrans(symbols, SUIT_SYMBOLS)) for suits, symbols in SUIT_PERMUTATIONS.items())
+FROM_CANONICAL_SUITS = dict((suits, maketrans(SUIT_SYMBOLS, symbols)) for suits, symbols in SUIT_PERMUTATIONS.items())
+
+
+def canonical_cards(hand, suits):
+    """Каноническая рука: масти переименованы, карты отсортированы"""
+    return sorted(' '.join(hand).translate(TO_CANONICAL_SUITS[suits]).split())
+
+
+def translate_suits(cards, suits):
+    """Канонические масти -> исходные"""
+    return ' '.join(cards).translate(FROM_CANONICAL_SUITS[suits]).split()
+
+
+def canonical_wild_hand(hand):
+    """Как canonical_hand, но масти переставляются только внутри цвета
+    или цвета меняются местами целиком. Ключ - по цвету: маски двух мастей
+    по убыванию и число джокеров этого цвета"""
+    mask = hand_mask(card for card in hand if card not in JOKER_SUITS)
+    colours = []
+    for joker, suits in sorted(JOKER_SUITS.items()):
+        masks = sorted(((suit_mask(mask, suit_index), suit_index) for suit_index in suits), reverse=True)
+        colours.append((tuple(suit_ranks for suit_ranks, _ in masks), hand.count(joker),
+                        [suit_index for _, suit_index in masks]))
+    colours.sort(reverse=True)
+    key = tuple((colour_masks, jokers) for colour_masks, jokers, _ in colours)
+    return key, tuple(suit_index for _, _, suits in colours for suit_index in suits)
+
+
+def canonical_wild_cards(key):
+    """Каноническая рука: первый цвет ключа - черный, второй - красный"""
+    cards = []
+    for (colour_masks, jokers), joker in zip(key, sorted(JOKER_SUITS)):
+        cards.extend(RANK_SYMBOLS[rank_index] + SUIT_SYMBOLS[suit_index]
+                     for suit_index, suit_ranks in zip(JOKER_SUITS[joker], colour_masks)
+                     for rank_index in reversed(mask_bits(suit_ranks)))
+        cards.extend([joker] * jokers)
+    return cards
+
+
+def restore_wild_cards(five, suits, hand):
+    """Пятерка канонической руки -> карты с исходными мастями в порядке исходной руки.
+    Замены джокеров занимают места джокеров того же цвета"""
+    cards = translate_suits(five, suits)
+    free_jokers = [position for position, card in enumerate(hand) if card in JOKER_SUITS]
+    positions = []
+    for card in cards:
+        if card in hand:
+            positions.append(hand.index(card))
+            continue
+        suit_index = SUIT_SYMBOLS.index(card[1])
+        position = [position for position in free_jokers if suit_index in JOKER_SUITS[hand[position]]][0]
+        free_jokers.remove(position)
+        positions.append(position)
+    return [card for _, card in sorted(zip(positions, cards))]
+
+
 def test_best_hand():
     print "test_best_hand..."
     assert (sorted(best_hand("6C 7C 8C 9C TC 5C JS".split()))
@@ -311,6 +963,37 @@ def test_best_wild_hand():
     print 'OK'
 
 
+def test_best_wild_hand_reference():
+    print "test_best_wild_hand_reference..."
+    rng = random.Random(1)
+    deck = sorted(CARD_CODES)
+    for jokers in [['?B'], ['?R']] * 10 + [['?B', '?R']] * 3:
+        hand = rng.sample(deck, 7 - len(jokers)) + jokers
+        rng.shuffle(hand)
+        fast = [encode_card(card) for card in best_wild_hand(hand)]
+        reference = [encode_card(card) for card in reference_best_wild_hand(hand)]
+        assert evaluate5(*fast) == evaluate5(*reference), hand
+    print 'OK'
+
+
+def test_best_hand_cache():
+    print "test_best_hand_cache..."
+    cache_clear()
+    assert best_hand("6C 7C 8C 9C TC 5C JS".split()) == ['6C', '7C', '8C', '9C', 'TC']
+    assert cache_info()['best_hand'].misses == 0
+    assert cached_best_hand("6C 7C 8C 9C TC 5C JS".split()) == ['6C', '7C', '8C', '9C', 'TC']
+    assert cached_best_hand("JH 6D 7D 8D 9D TD 5D".split()) == ['6D', '7D', '8D', '9D', 'TD']
+    assert cache_info()['best_hand'].hits == 1
+    assert (sorted(cached_best_wild_hand("6H 7H 8H 9H TH 5H ?R".split()))
+            == ['7H', '8H', '9H', 'JH', 'TH'])
+    assert (sorted(cached_best_wild_hand("6S 7S 8S 9S TS 5S ?B".split()))
+            == ['7S', '8S', '9S', 'JS', 'TS'])
+    assert cache_info()['best_wild_hand'].hits == 1
+    print 'OK'
+
+
 if __name__ == '__main__':
     test_best_hand()
     test_best_wild_hand()
+    test_best_wild_hand_reference()
+    test_best_hand_cache()
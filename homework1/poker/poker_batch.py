@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------
+# Пакетная оценка рук на NumPy (numpy - необязательная зависимость).
+#
+# Руки передаются массивом N x 7 целых кодов карт:
+#   код = номер ранга * 4 + номер масти (ранги RANK_SYMBOLS, масти SUIT_SYMBOLS),
+#   52 - черный джокер '?B', 53 - красный джокер '?R'.
+# Оценка идет сразу по 7ми картам, без перебора 21 пятерки:
+#   - сила без флеша зависит только от набора рангов, его ключ - сумма весов
+#     рангов (RANK_WEIGHTS, у всех наборов из 7ми карт суммы разные),
+#     по ключу берется номер набора, по номеру - сила;
+#   - флеш определяется по счетчикам мастей, его сила - по маске рангов масти.
+# Лучшая пятерка - первая в порядке перебора пятерка с ключом лучшей руки,
+# поэтому индексы совпадают с best_hand. Руки с джокерами разворачиваются
+# во все замены джокеров и оцениваются тем же путем.
+# -----------------
+
+import time
+from itertools import combinations, combinations_with_replacement
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from poker import (CARD_CODES, FLUSH_STRENGTH, JOKER_SUITS, PAIRED_STRENGTH, PRIME_MASK, RANK_BITS_SHIFT,
+                   RANK_SYMBOLS, SUIT_SYMBOLS, UNIQUE_STRENGTH, make_card_code)
+
+CARDS_NUMBER = 7
+JOKER_CODES = {'?B': 52, '?R': 53}
+CHUNK_SIZE = 16384
+# веса рангов, дающие разные суммы для любых 7ми карт (как в SKPokerEval)
+RANK_WEIGHTS = (0, 1, 5, 22, 98, 453, 2031, 8698, 22854, 83661, 262349, 636345, 1479181)
+COMBINATIONS = list(combinations(range(CARDS_NUMBER), 5))
+# две карты, не попавшие в пятерку, в порядке COMBINATIONS
+EXCLUDED = [tuple(i for i in range(CARDS_NUMBER) if i not in five) for five in COMBINATIONS]
+
+
+def card_code(card):
+    """Строка карты -> код для пакетной оценки"""
+    if card in JOKER_CODES:
+        return JOKER_CODES[card]
+    if card not in CARD_CODES:
+        raise Exception('Incorrect card format')
+    return RANK_SYMBOLS.index(card[0]) * 4 + SUIT_SYMBOLS.index(card[1])
+
+
+def card_string(code):
+    if code >= 52:
+        return [joker for joker, joker_code in JOKER_CODES.items() if joker_code == code][0]
+    return RANK_SYMBOLS[code >> 2] + SUIT_SYMBOLS[code & 3]
+
+
+def encode_hands(hands):
+    """Список рук-строк -> массив N x 7"""
+    require_numpy()
+    return np.array([[card_code(card) for card in hand] for hand in hands], dtype=np.int32).reshape(-1, CARDS_NUMBER)
+
+
+def decode_hands(codes):
+    """Массив кодов -> списки строк карт"""
+    require_numpy()
+    return [[card_string(code) for code in row] for row in np.asarray(codes).tolist()]
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError('poker_batch requires numpy')
+
+
+def rank_key(rank_indices):
+    return sum(RANK_WEIGHTS[rank_index] for rank_index in rank_indices)
+
+
+def combination_strengths(codes, paired_keys, paired_strengths):
+    """Сила каждой пятерки COMBINATIONS для рук без флеша (массив кодов poker, 7 x n)"""
+    rank_bits = (codes >> RANK_BITS_SHIFT) & 0x1FFF
+    primes = codes & PRIME_MASK
+    strengths = []
+    for five in COMBINATIONS:
+        ranks = np.bitwise_or.reduce(rank_bits[list(five)], axis=0)
+        product = np.prod(primes[list(five)], axis=0)
+        paired = paired_strengths[np.minimum(np.searchsorted(paired_keys, product), len(paired_keys) - 1)]
+        strength = np.array(UNIQUE_STRENGTH, dtype=np.int32)[ranks]
+        strengths.append(np.where(strength > 0, strength, paired))
+    return np.array(strengths)
+
+
+def build_tables():
+    """Таблицы для оценки 7ми карт.
+    Без флеша: номер набора рангов по ключу, сила и ключ лучшей пятерки по номеру.
+    Флеш: сила и маска лучшей пятерки по маске рангов масти"""
+    rank_sets = [ranks for ranks in combinations_with_replacement(range(len(RANK_SYMBOLS)), CARDS_NUMBER)
+                 if max(ranks.count(rank) for rank in ranks) <= 4]
+    # масти раздаются по кругу, так что флеша нет
+    codes = np.array([[make_card_code(rank, i % 4) for i, rank in enumerate(ranks)] for ranks in rank_sets],
+                     dtype=np.int64).T
+    paired_keys = np.array(sorted(PAIRED_STRENGTH), dtype=np.int64)
+    paired_strengths = np.array([PAIRED_STRENGTH[key] for key in paired_keys.tolist()], dtype=np.int32)
+    strengths = combination_strengths(codes, paired_keys, paired_strengths)
+    best = strengths.argmax(axis=0)
+    weights = np.array(RANK_WEIGHTS, dtype=np.int32)[(codes >> 8) & 0xF]
+    keys = weights.sum(axis=0)
+    if len(np.unique(keys)) != len(rank_sets):
+        raise ValueError('RANK_WEIGHTS do not separate rank sets')
+    best_keys = np.array(COMBINATIONS)[best].T
+    best_keys = weights[best_keys, np.arange(len(rank_sets))].sum(axis=0)
+    rank_set_index = np.zeros(keys.max() + 1, dtype=np.uint16)
+    rank_set_index[keys] = np.arange(len(rank_sets))
+
+    flush_strength = np.zeros(1 << len(RANK_SYMBOLS), dtype=np.int32)
+    flush_best = np.zeros(1 << len(RANK_SYMBOLS), dtype=np.int32)
+    masks = np.arange(1 << len(RANK_SYMBOLS))
+    five_strengths = np.array(FLUSH_STRENGTH, dtype=np.int32)
+    for five in combinations(range(len(RANK_SYMBOLS)), 5):
+        five_mask = sum(1 << bit for bit in five)
+        better = ((masks & five_mask) == five_mask) & (five_strengths[five_mask] > flush_strength)
+        flush_strength[better] = five_strengths[five_mask]
+        flush_best[better] = five_mask
+    return (rank_set_index, strengths.max(axis=0).astype(np.int32), best_keys.astype(np.int32),
+            flush_strength, flush_best)
+
+
+if np is not None:
+    RANK_SET_INDEX, RANK_SET_STRENGTH, RANK_SET_BEST_KEY, FLUSH7_STRENGTH, FLUSH7_BEST = build_tables()
+    CODE_RANK_KEY = np.array([RANK_WEIGHTS[code >> 2] for code in range(52)], dtype=np.int32)
+    CODE_SUIT_COUNT = np.array([1 << (4 * (code & 3)) for code in range(52)], dtype=np.int32)
+    CODE_SUIT = np.array([code & 3 for code in range(52)], dtype=np.int32)
+    CODE_RANK_BIT = np.array([1 << (code >> 2) for code in range(52)], dtype=np.int32)
+    COMBINATION_INDICES = np.array(COMBINATIONS, dtype=np.int8)
+    EXCLUDED_FIRST = np.array([pair[0] for pair in EXCLUDED])
+    EXCLUDED_SECOND = np.array([pair[1] for pair in EXCLUDED])
+    # замены джокеров в порядке JokerIterator: масти цвета, внутри - ранги по возрастанию
+    JOKER_REPLACEMENTS = np.array(
+        [[rank * 4 + suit for suit in JOKER_SUITS[joker] for rank in range(len(RANK_SYMBOLS))]
+         for joker in sorted(JOKER_CODES, key=JOKER_CODES.get)], dtype=np.int32)
+
+
+def evaluate_concrete(cards):
+    """Сила и номер лучшей пятерки (в COMBINATIONS) для рук без джокеров.
+    cards - массив 7 x n (по строке на позицию карты)"""
+    rank_keys = CODE_RANK_KEY[cards]
+    key = rank_keys.sum(axis=0)
+    rank_set = RANK_SET_INDEX[key]
+    strength = RANK_SET_STRENGTH[rank_set]
+    # пятерка лучшая, если сумма весов двух выброшенных карт равна key - ключ лучшей пятерки
+    excluded = rank_keys[EXCLUDED_FIRST]
+    excluded += rank_keys[EXCLUDED_SECOND]
+    matches = excluded == key - RANK_SET_BEST_KEY[rank_set]
+
+    suit_counts = CODE_SUIT_COUNT[cards].sum(axis=0)
+    flush_suit = np.zeros_like(suit_counts)
+    has_flush = np.zeros(suit_counts.shape, dtype=bool)
+    for suit in range(len(SUIT_SYMBOLS)):
+        suited = ((suit_counts >> (4 * suit)) & 0xF) >= 5
+        flush_suit[suited] = suit
+        has_flush |= suited
+    flushes = np.nonzero(has_flush)[0]
+    if len(flushes):
+        flush_cards = cards[:, flushes]
+        suit_bits = np.where(CODE_SUIT[flush_cards] == flush_suit[flushes], CODE_RANK_BIT[flush_cards], 0)
+        ranks_mask = suit_bits.sum(axis=0)
+        strength[flushes] = FLUSH7_STRENGTH[ranks_mask]
+        matches[:, flushes] = (ranks_mask - suit_bits[EXCLUDED_FIRST] - suit_bits[EXCLUDED_SECOND]) == \
+            FLUSH7_BEST[ranks_mask]
+    return strength, matches.argmax(axis=0)
+
+
+def expand_jokers(cards):
+    """Все замены джокеров (массив n x 7). Возвращает развернутые руки
+    и признак допустимости (нет повторов карт).
+    Замены одной руки идут подряд в порядке JokerIterator, по 26 на каждый джокер"""
+    expanded = cards
+    while True:
+        rows = np.arange(len(expanded))
+        positions = np.argmax(expanded >= 52, axis=1)
+        jokers = expanded[rows, positions]
+        has_joker = jokers >= 52
+        if not has_joker.any():
+            break
+        counts = np.where(has_joker, JOKER_REPLACEMENTS.shape[1], 1)
+        source = np.repeat(rows, counts)
+        offset = np.arange(len(source)) - np.repeat(np.cumsum(counts) - counts, counts)
+        replaced = np.nonzero(has_joker[source])[0]
+        expanded = expanded[source]
+        expanded[replaced, positions[source[replaced]]] = \
+            JOKER_REPLACEMENTS[jokers[source[replaced]] - 52, offset[replaced]]
+    ordered = np.sort(expanded, axis=1)
+    valid = (np.diff(ordered, axis=1) != 0).all(axis=1)
+    return expanded, valid
+
+
+def evaluate_resolved(cards):
+    """Сила, индексы лучшей пятерки и руки с замененными джокерами"""
+    require_numpy()
+    cards = np.asarray(cards, dtype=np.int32).reshape(-1, CARDS_NUMBER)
+    if len(cards) and (cards.min() < 0 or cards.max() > 53):
+        raise ValueError('card codes must be in 0..53')
+    strengths = np.zeros(len(cards), dtype=np.int32)
+    best = np.zeros((len(cards), 5), dtype=np.int8)
+    resolved = cards.copy()
+    jokers_number = (cards >= 52).sum(axis=1)
+    for number in np.unique(jokers_number):
+        rows_with_number = np.nonzero(jokers_number == number)[0]
+        step = max(1, CHUNK_SIZE // JOKER_REPLACEMENTS.shape[1] ** number)
+        for start in range(0, len(rows_with_number), step):
+            rows = rows_with_number[start:start + step]
+            if number == 0:
+                strength, combination = evaluate_concrete(np.ascontiguousarray(cards[rows].T))
+                strengths[rows] = strength
+                best[rows] = COMBINATION_INDICES[combination]
+                continue
+            expanded, valid = expand_jokers(cards[rows])
+            strength, combination = evaluate_concrete(np.ascontiguousarray(np.where(valid[:, None], expanded, 0).T))
+            strength[~valid] = 0
+            # у всех рук куска одинаковое число замен: первая замена с наибольшей силой
+            width = JOKER_REPLACEMENTS.shape[1] ** number
+            choice = strength.reshape(len(rows), width).argmax(axis=1) + np.arange(len(rows)) * width
+            strengths[rows] = strength[choice]
+            best[rows] = COMBINATION_INDICES[combination[choice]]
+            resolved[rows] = expanded[choice]
+    return strengths, best, resolved
+
+
+def evaluate_batch(cards):
+    """Массив N x 7 кодов карт -> (силы N, индексы лучшей пятерки N x 5).
+    Силы совпадают с evaluate5/best_combination модуля poker"""
+    strengths, best, _ = evaluate_resolved(cards)
+    return strengths, best
+
+
+def best_hands_batch(cards):
+    """Массив N x 7 кодов карт -> (силы N, коды лучшей пятерки N x 5).
+    Для рук с джокерами в пятерке стоят выбранные замены"""
+    strengths, best, resolved = evaluate_resolved(cards)
+    return strengths, np.take_along_axis(resolved, best.astype(np.intp), axis=1)
+
+
+if __name__ == '__main__':
+    require_numpy()
+    rng = np.random.RandomState(0)
+    hands_number = 1000000
+    cards = np.argsort(rng.rand(hands_number, 52), axis=1)[:, :CARDS_NUMBER].astype(np.int32)
+    started = time.time()
+    evaluate_batch(cards)
+    elapsed = time.time() - started
+    print "%s hands in %.2f s, %.0f hands/s" % (hands_number, elapsed, hands_number / elapsed)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------
+# Замеры скорости и дифференциальная проверка вычислителей poker.
+#
+# HandGenerator раздает воспроизводимые по seed случайные руки, в том
+# числе с 0-2 джокерами. bench считает руки в секунду для hand_rank,
+# best_hand, best_wild_hand и их вариантов с кешем. diff сверяет быстрый
+# вычислитель с эталонной реализацией и останавливается на первом
+# расхождении.
+#
+# Запуск:
+#   python poker_bench.py bench -n 20000 --seed 1
+#   python poker_bench.py diff --check best_hand -n 1000000 --seed 1
+# -----------------
+
+import itertools
+import random
+import sys
+import time
+from collections import namedtuple
+from optparse import OptionParser
+
+import poker
+
+DECK = sorted(poker.CARD_CODES)
+JOKERS = sorted(poker.JOKER_SUITS)
+
+Mismatch = namedtuple('Mismatch', 'index hand expected actual')
+
+
+class HandGenerator:
+    """ Случайные руки, воспроизводимые по seed. Число джокеров в руке
+    выбирается равновероятно из jokers """
+
+    def __init__(self, seed=None, size=7, jokers=(0,)):
+        self.rng = random.Random(seed)
+        self.size = size
+        self.jokers = tuple(jokers)
+
+    def next_hand(self):
+        jokers_number = self.rng.choice(self.jokers)
+        if jokers_number == len(JOKERS):
+            jokers = list(JOKERS)
+        else:
+            jokers = self.rng.sample(JOKERS, jokers_number)
+        hand = self.rng.sample(DECK, self.size - len(jokers)) + jokers
+        self.rng.shuffle(hand)
+        return hand
+
+    def hands(self, number):
+        return [self.next_hand() for _ in range(number)]
+
+
+def hands_per_second(func, hands, repeat=3, setup=None):
+    """Лучшая из repeat скорость обработки рук, setup вызывается перед каждым прогоном"""
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.time()
+        for hand in hands:
+            func(hand)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(hands) / best if best else float('inf')
+
+
+def rank_five(hand):
+    return poker.hand_rank(poker.Hand(hand))
+
+
+# имя -> (функция, размер руки, варианты числа джокеров, сбрасывать ли кеш перед прогоном)
+BENCH_TARGETS = {
+    'hand_rank': (rank_five, 5, (0,), False),
+    'best_hand': (poker.best_hand, 7, (0,), False),
+    'cached_best_hand': (poker.cached_best_hand, 7, (0,), True),
+    'cached_best_hand_warm': (poker.cached_best_hand, 7, (0,), False),
+    'compute_best_hand': (poker.compute_best_hand, 7, (0,), False),
+    'reference_best_hand': (poker.reference_best_hand, 7, (0,), False),
+    'best_wild_hand': (poker.best_wild_hand, 7, (1, 2), False),
+    'cached_best_wild_hand': (poker.cached_best_wild_hand, 7, (1, 2), True),
+    'compute_best_wild_hand': (poker.compute_best_wild_hand, 7, (1, 2), False),
+    'reference_best_wild_hand': (poker.reference_best_wild_hand, 7, (1, 2), False),
+}
+DEFAULT_BENCH_TARGETS = ['hand_rank', 'best_hand', 'cached_best_hand', 'cached_best_hand_warm',
+                         'compute_best_hand', 'best_wild_hand', 'cached_best_wild_hand', 'compute_best_wild_hand']
+
+
+def bench(targets=DEFAULT_BENCH_TARGETS, number=20000, seed=None, repeat=3):
+    """Скорость каждого вычислителя в руках в секунду"""
+    results = []
+    for name in targets:
+        func, size, jokers, cold = BENCH_TARGETS[name]
+        hands = HandGenerator(seed, size, jokers).hands(number)
+        # прогрев, чтобы cached_best_hand_warm мерил попадания в кеш
+        poker.cache_clear()
+        if not cold:
+            for hand in hands:
+                func(hand)
+        results.append((name, hands_per_second(func, hands, repeat, poker.cache_clear if cold else None)))
+    return results
+
+
+def result_strength(hand, five):
+    """Сила пятерки или None, если она не может быть получена из руки:
+    карты должны быть разными, взятыми из руки или заменами джокеров по цвету"""
+    if len(five) != 5 or len(set(five)) != 5:
+        return None
+    free_jokers = [card for card in hand if card in poker.JOKER_SUITS]
+    for card in five:
+        if card in hand and card not in poker.JOKER_SUITS:
+            continue
+        if card not in poker.CARD_CODES:
+            return None
+        suit_index = poker.SUIT_SYMBOLS.index(card[1])
+        matching = [joker for joker in free_jokers if suit_index in poker.JOKER_SUITS[joker]]
+        if not matching:
+            return None
+        free_jokers.remove(matching[0])
+    return poker.evaluate5(*[poker.encode_card(card) for card in five])
+
+
+def same_strength(hand, expected, actual):
+    return result_strength(hand, actual) is not None and \
+        result_strength(hand, actual) == result_strength(hand, expected)
+
+
+def same_value(hand, expected, actual):
+    return expected == actual
+
+
+def each(func):
+    """Функция от руки -> функция от списка рук"""
+    return lambda hands: [func(hand) for hand in hands]
+
+
+def differential(candidate, reference, hands, same=same_strength, chunk=10000):
+    """Сверяет candidate с reference на потоке рук. Обе функции принимают
+    список рук и возвращают список результатов. Возвращает (число
+    проверенных рук, первое расхождение или None)"""
+    checked = 0
+    batch = []
+    for hand in itertools.chain(hands, [None]):
+        if hand is not None:
+            batch.append(hand)
+        if len(batch) == chunk or (hand is None and batch):
+            for hand_in_batch, expected, actual in zip(batch, reference(batch), candidate(batch)):
+                if not same(hand_in_batch, expected, actual):
+                    return checked, Mismatch(checked, hand_in_batch, expected, actual)
+                checked += 1
+            batch = []
+    return checked, None
+
+
+def reference_hand_rank(hand):
+    """hand_rank через сортировку рангов, как до перехода на битовые маски"""
+    ranks = poker.sorted_ranks([poker.RANK_VALUES[card[0]] for card in hand])
+    return poker.ranks_rank(ranks, len(set(card[1] for card in hand)) == 1)
+
+
+def batch_best_hands(hands):
+    import poker_batch
+    _, cards = poker_batch.best_hands_batch(poker_batch.encode_hands(hands))
+    return poker_batch.decode_hands(cards)
+
+
+def table_best_hands(hands):
+    if poker.SEVEN_CARD_TABLE is None:
+        raise Exception('7-card table is not loaded, build it with poker_table.py')
+    return [poker.compute_best_hand(hand) for hand in hands]
+
+
+# имя -> (проверяемая функция, эталон, размер руки, варианты числа джокеров, сравнение)
+CHECKS = {
+    'hand_rank': (each(rank_five), each(reference_hand_rank), 5, (0,), same_value),
+    'best_hand': (each(poker.best_hand), each(poker.reference_best_hand), 7, (0,), same_strength),
+    'best_hand_exact': (each(poker.compute_best_hand), each(poker.reference_best_hand), 7, (0,), same_value),
+    'best_wild_hand': (each(poker.best_wild_hand), each(poker.reference_best_wild_hand), 7, (1, 2), same_strength),
+    'cache': (each(poker.cached_best_hand), each(poker.compute_best_hand), 7, (0,), same_strength),
+    'wild_cache': (each(poker.cached_best_wild_hand), each(poker.compute_best_wild_hand), 7, (1, 2), same_strength),
+    'batch': (batch_best_hands, each(poker.compute_best_wild_hand), 7, (0, 1, 2), same_strength),
+    'table': (table_best_hands, each(poker.reference_best_hand), 7, (0,), same_value),
+}
+
+
+def run_check(name, number, seed=None):
+    candidate, reference, size, jokers, same = CHECKS[name]
+    generator = HandGenerator(seed, size, jokers)
+    hands = (generator.next_hand() for _ in range(number))
+    return differential(candidate, reference, hands, same)
+
+
+if __name__ == '__main__':
+    op = OptionParser(usage='%prog bench|diff [options]')
+    op.add_option('-n', '--number', type='int', default=20000, help='hands to generate')
+    op.add_option('-s', '--seed', type='int', default=1)
+    op.add_option('-r', '--repeat', type='int', default=3)
+    op.add_option('-t', '--targets', default=','.join(DEFAULT_BENCH_TARGETS),
+                  help='bench targets: %s' % ', '.join(sorted(BENCH_TARGETS)))
+    op.add_option('-c', '--check', default='best_hand', help='diff check: %s' % ', '.join(sorted(CHECKS)))
+    (opts, args) = op.parse_args()
+    if len(args) != 1 or args[0] not in ('bench', 'diff'):
+        op.error('expected bench or diff')
+    if args[0] == 'diff' and opts.check == 'table' and poker.SEVEN_CARD_TABLE is None:
+        op.error('7-card table is not loaded, build it with poker_table.py')
+    if args[0] == 'bench':
+        for name, speed in bench(opts.targets.split(','), opts.number, opts.seed, opts.repeat):
+            print '%-26s %12.0f hands/s' % (name, speed)
+    else:
+        started = time.time()
+        checked, mismatch = run_check(opts.check, opts.number, opts.seed)
+        elapsed = time.time() - started
+        if mismatch is None:
+            print '%s: %s hands OK in %.1f s' % (opts.check, checked, elapsed)
+        else:
+            print '%s: mismatch at hand #%s after %.1f s' % (opts.check, mismatch.index, elapsed)
+            print '  hand:      %s' % ' '.join(mismatch.hand)
+            print '  expected:  %s' % (mismatch.expected,)
+            print '  actual:    %s' % (mismatch.actual,)
+            sys.exit(1)
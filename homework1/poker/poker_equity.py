@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------
+# Вероятности выигрыша и ничьей для карманных карт против N соперников
+# при частично открытом борде.
+#
+# Недостающие карты борда и карты соперников раздаются случайно,
+# руки сравниваются по силе best_combination. Раздачи делятся на куски
+# фиксированного размера, у каждого куска свой генератор с зерном
+# seed * CHUNK_SEED_FACTOR + номер куска, поэтому результат при заданном
+# seed не зависит от числа процессов. Если всех раскладов меньше
+# exhaustive_limit, они перебираются полностью.
+#
+# Запуск: python poker_equity.py AS KS --board "QS JS 2C" --opponents 2
+# -----------------
+
+import math
+import random
+from collections import namedtuple
+from itertools import combinations
+from multiprocessing import Pool
+from optparse import OptionParser
+
+from poker import CARD_CODES, best_combination, encode_card
+
+CHUNK_TRIALS = 5000
+CHUNK_SEED_FACTOR = 1000003
+BOARD_SIZE = 5
+
+EquityResult = namedtuple('EquityResult', 'win tie loss equity stderr trials exhaustive')
+
+
+def hand_strength(codes):
+    return best_combination(codes)[0]
+
+
+def showdown(hole, board, opponents_holes):
+    """Доля банка героя в одной раздаче: 1 - выигрыш, 1/k - дележ на k, 0 - проигрыш"""
+    strength = hand_strength(hole + board)
+    tied = 1
+    for opponent in opponents_holes:
+        opponent_strength = hand_strength(opponent + board)
+        if opponent_strength > strength:
+            return 0.0
+        if opponent_strength == strength:
+            tied += 1
+    return 1.0 / tied
+
+
+class Tally(object):
+    """Счетчики исходов раздач"""
+
+    def __init__(self, wins=0, ties=0, losses=0, share=0.0, share_squares=0.0):
+        self.wins = wins
+        self.ties = ties
+        self.losses = losses
+        self.share = share
+        self.share_squares = share_squares
+
+    def add(self, share):
+        if share == 1.0:
+            self.wins += 1
+        elif share:
+            self.ties += 1
+        else:
+            self.losses += 1
+        self.share += share
+        self.share_squares += share * share
+
+    def merge(self, other):
+        return Tally(self.wins + other.wins, self.ties + other.ties, self.losses + other.losses,
+                     self.share + other.share, self.share_squares + other.share_squares)
+
+    def as_tuple(self):
+        return self.wins, self.ties, self.losses, self.share, self.share_squares
+
+    def result(self, exhaustive):
+        trials = self.wins + self.ties + self.losses
+        mean = self.share / trials
+        if exhaustive or trials < 2:
+            stderr = 0.0
+        else:
+            variance = max(0.0, (self.share_squares - trials * mean * mean) / (trials - 1))
+            stderr = math.sqrt(variance / trials)
+        return EquityResult(float(self.wins) / trials, float(self.ties) / trials, float(self.losses) / trials,
+                            mean, stderr, trials, exhaustive)
+
+
+def simulate_chunk(task):
+    """Кусок случайных раздач. Выполняется в процессе пула, поэтому получает и
+    возвращает простые кортежи"""
+    hole, board, deck, opponents, trials, seed = task
+    rng = random.Random(seed)
+    missing = BOARD_SIZE - len(board)
+    dealt = missing + 2 * opponents
+    tally = Tally()
+    for _ in range(trials):
+        cards = rng.sample(deck, dealt)
+        full_board = board + cards[:missing]
+        opponents_holes = [cards[missing + 2 * i:missing + 2 * i + 2] for i in range(opponents)]
+        tally.add(showdown(hole, full_board, opponents_holes))
+    return tally.as_tuple()
+
+
+def deal_opponents(deck, opponents):
+    """Все упорядоченные раздачи карманных карт соперникам"""
+    if opponents == 0:
+        yield []
+        return
+    for first in combinations(deck, 2):
+        rest = [card for card in deck if card not in first]
+        for others in deal_opponents(rest, opponents - 1):
+            yield [list(first)] + others
+
+
+def completions_number(deck_size, missing, opponents):
+    number = choose(deck_size, missing)
+    deck_size -= missing
+    for _ in range(opponents):
+        number *= choose(deck_size, 2)
+        deck_size -= 2
+    return number
+
+
+def choose(n, k):
+    if k < 0 or k > n:
+        return 0
+    result = 1
+    for i in range(k):
+        result = result * (n - i) // (i + 1)
+    return result
+
+
+def enumerate_all(hole, board, deck, opponents):
+    tally = Tally()
+    for cards in combinations(deck, BOARD_SIZE - len(board)):
+        full_board = board + list(cards)
+        rest = [card for card in deck if card not in cards]
+        for opponents_holes in deal_opponents(rest, opponents):
+            tally.add(showdown(hole, full_board, opponents_holes))
+    return tally
+
+
+def equity(hole_cards, board_cards=(), opponents=1, trials=100000, seed=None, processes=None,
+           exhaustive_limit=100000):
+    """Вероятности выигрыша, ничьей и проигрыша героя, его доля банка (equity)
+    и стандартная ошибка доли. hole_cards - две карты героя, board_cards - до 5ти
+    открытых карт, processes - число процессов (None - по числу ядер, 1 - без пула)"""
+    hole = [encode_card(card) for card in hole_cards]
+    board = [encode_card(card) for card in board_cards]
+    if len(hole) != 2:
+        raise ValueError('Expected two hole cards')
+    if len(board) > BOARD_SIZE:
+        raise ValueError('Board has at most %s cards' % BOARD_SIZE)
+    if len(set(hole + board)) != len(hole) + len(board):
+        raise ValueError('Duplicate cards')
+    if opponents < 1:
+        raise ValueError('At least one opponent is required')
+    if trials < 1:
+        raise ValueError('At least one trial is required')
+    deck = sorted(code for code in CARD_CODES.values() if code not in hole + board)
+    missing = BOARD_SIZE - len(board)
+    if missing + 2 * opponents > len(deck):
+        raise ValueError('Not enough cards for %s opponents' % opponents)
+
+    if completions_number(len(deck), missing, opponents) <= exhaustive_limit:
+        return enumerate_all(hole, board, deck, opponents).result(exhaustive=True)
+
+    if seed is None:
+        seed = random.SystemRandom().randint(0, 2 ** 31)
+    tasks = []
+    for chunk, start in enumerate(range(0, trials, CHUNK_TRIALS)):
+        tasks.append((hole, board, deck, opponents, min(CHUNK_TRIALS, trials - start),
+                      seed * CHUNK_SEED_FACTOR + chunk))
+    if processes == 1 or len(tasks) == 1:
+        chunks = map(simulate_chunk, tasks)
+    else:
+        pool = Pool(processes)
+        try:
+            chunks = pool.map(simulate_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    tally = Tally()
+    for chunk in chunks:
+        tally = tally.merge(Tally(*chunk))
+    return tally.result(exhaustive=False)
+
+
+if __name__ == '__main__':
+    op = OptionParser(usage='%prog CARD CARD [options]')
+    op.add_option('-b', '--board', default='', help='open board cards, e.g. "QS JS 2C"')
+    op.add_option('-o', '--opponents', type='int', default=1)
+    op.add_option('-t', '--trials', type='int', default=100000)
+    op.add_option('-s', '--seed', type='int', default=None)
+    op.add_option('-p', '--processes', type='int', default=None)
+    op.add_option('--exhaustive-limit', type='int', default=100000)
+    (opts, args) = op.parse_args()
+    if len(args) != 2:
+        op.error('expected two hole cards')
+    result = equity(args, opts.board.split(), opts.opponents, opts.trials, opts.seed, opts.processes,
+                    opts.exhaustive_limit)
+    print 'win %.4f tie %.4f loss %.4f equity %.4f +- %.4f (%s %s)' % (
+        result.win, result.tie, result.loss, result.equity, result.stderr, result.trials,
+        'exhaustive' if result.exhaustive else 'trials')
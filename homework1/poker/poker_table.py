@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------
+# Генератор таблицы состояний для оценки 7ми карт
+# (в стиле вычислителя "two-plus-two").
+#
+# Состояние - набор уже сданных карт. Масти, которые уже не могут
+# собрать флеш, забываются, поэтому состояний немного (~600 тыс.).
+# Для каждого состояния в таблице 53 ячейки: ячейка (смещение + карта)
+# хранит смещение следующего состояния, а после седьмой карты - силу руки.
+# Карты нумеруются от 1 до 52: номер = ранг * 4 + масть + 1.
+#
+# Запуск: python poker_table.py [путь к файлу таблицы]
+# -----------------
+
+import os
+import struct
+import sys
+import time
+from array import array
+
+import poker
+
+CARDS_NUMBER = 7
+ROW_SIZE = 53
+
+
+def make_state(state, card):
+    """Новое состояние после добавления карты или None, если такой руки не бывает.
+    Состояние - отсортированный кортеж чисел ранг * 5 + (масть + 1), 0 - масть забыта"""
+    rank, suit = divmod(card - 1, 4)
+    element = rank * 5 + suit + 1
+    if element in state:
+        return None
+    if sum(1 for value in state if value // 5 == rank) >= 4:
+        return None
+    elements = list(state)
+    elements.append(element)
+    left = CARDS_NUMBER - len(elements)
+    suit_counts = [0] * 5
+    for value in elements:
+        suit_counts[value % 5] += 1
+    for known_suit in range(1, 5):
+        if suit_counts[known_suit] and suit_counts[known_suit] + left < 5:
+            elements = [value - known_suit if value % 5 == known_suit else value for value in elements]
+    elements.sort(reverse=True)
+    return tuple(elements)
+
+
+class FinalEvaluator(object):
+    """Сила руки из 7ми карт по состоянию после шести карт и седьмой карте.
+    Результаты без флеша зависят только от рангов, поэтому запоминаются"""
+
+    def __init__(self):
+        self.plain = {}
+        self.flush = {}
+
+    def __call__(self, state, card):
+        rank, suit = divmod(card - 1, 4)
+        element = rank * 5 + suit + 1
+        if element in state or sum(1 for value in state if value // 5 == rank) >= 4:
+            return 0
+        ranks = sorted([value // 5 for value in state] + [rank], reverse=True)
+        strength = self.plain_strength(tuple(ranks))
+        elements = state + (element,)
+        for known_suit in range(1, 5):
+            flush_ranks = [value // 5 for value in elements if value % 5 == known_suit]
+            if len(flush_ranks) >= 5:
+                strength = max(strength, self.flush_strength(tuple(sorted(flush_ranks, reverse=True))))
+        return strength
+
+    def plain_strength(self, ranks):
+        strength = self.plain.get(ranks)
+        if strength is None:
+            # масти раздаются по кругу, так что флеша точно нет
+            codes = [poker.make_card_code(rank, i % 4) for i, rank in enumerate(ranks)]
+            strength = self.plain[ranks] = poker.best_combination(codes)[0]
+        return strength
+
+    def flush_strength(self, ranks):
+        strength = self.flush.get(ranks)
+        if strength is None:
+            codes = [poker.make_card_code(rank, 0) for rank in ranks]
+            strength = self.flush[ranks] = poker.best_combination(codes)[0]
+        return strength
+
+
+def generate():
+    """Строит таблицу переходов, возвращает array('i')"""
+    states = {(): 0}
+    frontier = [()]
+    for depth in range(1, CARDS_NUMBER):
+        next_frontier = []
+        for state in frontier:
+            for card in range(1, ROW_SIZE):
+                new_state = make_state(state, card)
+                if new_state is not None and new_state not in states:
+                    states[new_state] = len(states)
+                    next_frontier.append(new_state)
+        frontier = next_frontier
+    table = array('i', [0]) * (len(states) * ROW_SIZE)
+    final = FinalEvaluator()
+    for state, index in states.iteritems():
+        offset = index * ROW_SIZE
+        if len(state) == CARDS_NUMBER - 1:
+            for card in range(1, ROW_SIZE):
+                table[offset + card] = final(state, card)
+        else:
+            for card in range(1, ROW_SIZE):
+                new_state = make_state(state, card)
+                if new_state is not None:
+                    table[offset + card] = states[new_state] * ROW_SIZE
+    return table
+
+
+def write(table, path):
+    if sys.byteorder != 'little':
+        table.byteswap()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack(poker.SEVEN_CARD_TABLE_HEADER, poker.SEVEN_CARD_TABLE_MAGIC,
+                            poker.SEVEN_CARD_TABLE_VERSION, len(table)))
+        table.tofile(f)
+    os.rename(tmp_path, path)
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else poker.SEVEN_CARD_TABLE_PATH
+    started = time.time()
+    table = generate()
+    write(table, path)
+    print "%s entries written to %s in %.1f s" % (len(table), path, time.time() - started)
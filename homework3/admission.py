@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class RateLimiter(object):
+    """Per-key token buckets. Each key gets `rate` tokens per second
+    up to `burst`. Least recently seen keys are dropped past max_keys."""
+
+    def __init__(self, rate, burst, max_keys=100000, clock=time.time):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_keys = max_keys
+        self.clock = clock
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def allow(self, key):
+        now = self.clock()
+        with self.lock:
+            bucket = self.buckets.pop(key, None)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            allowed = tokens >= 1.0
+            if allowed:
+                tokens -= 1.0
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+            return allowed
+
+
+class AdmissionController(object):
+    """Rejects requests once too many are in flight or a request
+    waited too long in the server queue for a worker."""
+
+    def __init__(self, max_in_flight=None, max_queue_wait=None):
+        self.max_in_flight = max_in_flight
+        self.max_queue_wait = max_queue_wait
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self, queue_wait=0.0):
+        if self.max_queue_wait is not None and queue_wait > self.max_queue_wait:
+            return False
+        with self.lock:
+            if self.max_in_flight is not None and self.in_flight >= self.max_in_flight:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
@@ -2,14 +2,28 @@
 # -*- coding: utf-8 -*-
 
 import abc
-import json
+import hashlib
+import itertools
 import datetime
+import json
 import logging
-import hashlib
+import socket
+import threading
+import time
 import uuid
+import Queue
 from optparse import OptionParser
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
-from scoring import get_interests, get_score
+from admission import AdmissionController, RateLimiter
+from auth import Authenticator, HourlyTokenVerifier, SaltedTokenVerifier
+from idempotency import FingerprintMismatch, IdempotencyCache
+from interests_index import InterestsIndex
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, registry
+from request_log import RequestLogger
+from scoring import get_interests_many, get_score
+from store import Store
+from transport import (BodyTooLarge, CODECS, JSON, choose_encoding, decode_body, encode_body, error_bodies,
+                       request_codec, response_codec)
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
@@ -18,15 +32,37 @@ OK = 200
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
+REQUEST_ENTITY_TOO_LARGE = 413
+UNSUPPORTED_MEDIA_TYPE = 415
 INVALID_REQUEST = 422
+TOO_MANY_REQUESTS = 429
 INTERNAL_ERROR = 500
+SERVICE_UNAVAILABLE = 503
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
+    REQUEST_ENTITY_TOO_LARGE: "Request Entity Too Large",
+    UNSUPPORTED_MEDIA_TYPE: "Unsupported Media Type",
     INVALID_REQUEST: "Invalid Request",
+    TOO_MANY_REQUESTS: "Too Many Requests",
     INTERNAL_ERROR: "Internal Server Error",
+    SERVICE_UNAVAILABLE: "Service Unavailable",
 }
+ERROR_BODIES = dict((content_type, error_bodies(ERRORS, codec.dumps)) for content_type, codec in CODECS.items())
+# sent by the accept loop without reading the request, so always JSON
+QUEUE_FULL_RESPONSE = "\r\n".join([
+    "HTTP/1.0 %s %s" % (SERVICE_UNAVAILABLE, ERRORS[SERVICE_UNAVAILABLE]),
+    "Content-Type: %s" % JSON.content_type,
+    "Content-Length: %s" % len(ERROR_BODIES[JSON.content_type][SERVICE_UNAVAILABLE]),
+    "Connection: close",
+    "",
+    ERROR_BODIES[JSON.content_type][SERVICE_UNAVAILABLE],
+])
+RETRYABLE_CODES = (TOO_MANY_REQUESTS, INTERNAL_ERROR, SERVICE_UNAVAILABLE)
+REQUEST_ID_HEADER = "X-Request-ID"
+TIMEOUT_HEADER = "X-Request-Timeout"
+REQUEST_ID_REUSED = REQUEST_ID_HEADER + " was already used for a different request"
 UNKNOWN = 0
 MALE = 1
 FEMALE = 2
@@ -37,103 +73,91 @@ GENDERS = {
 }
 
 
-class Field(object):
-    value = None
+INVALID = object()
+EMPTY_VALUES = ('', [], {}, ())
 
-    def __init__(self, required=False, nullable=True):
-        self.required = required
-        self.nullable = nullable
 
-    def set_value(self, value):
-        self.value = value
-        return self
-
-    def validate(self):
-        return self.check_required() and self.check_nullable()
+def is_empty(value):
+    return value is None or value in EMPTY_VALUES
 
-    def check_required(self):
-        return not self.required or self.value is not None
 
-    def check_nullable(self):
-        return self.nullable or (self.value is not None and len(self.value) != 0)
-
-    def empty(self):
-        return self.value is None or len(self.value) == 0
-
-    def count(self):
-        return 0 if self.value is None else len(str(self.value))
-
-    def __str__(self):
-        return '' if self.value is None else self.value.encode('utf-8')
-
-    def __radd__(self, other):
-        return str(self) + other
-
-    def __eq__(self, other):
-        return str(self) == str(other)
+class Field(object):
+    """Declarative field description. Holds no per-request state, only
+    builds the validator that RequestMeta compiles once per class."""
+    creation_counter = itertools.count()
+    # the cleaned value is kept in attr + cache_suffix, e.g. birthday_parsed
+    cache_suffix = None
 
-    def __hash__(self):
-        return hash(self.value)
+    def __init__(self, required=False, nullable=True, key=None):
+        self.required = required
+        self.nullable = nullable
+        self.key = key
+        self.order = next(self.creation_counter)
 
+    def compile(self):
+        required, nullable, clean = self.required, self.nullable, self.clean
 
-class IterableField(Field):
-    def __iter__(self):
-        return iter(self.value)
+        def validator(value):
+            if value is None:
+                return INVALID if required else None
+            if value in EMPTY_VALUES:
+                return value if nullable else INVALID
+            return clean(value)
+        return validator
 
-    def __getitem__(self, item):
-        return self.value[item]
+    def clean(self, value):
+        return value
 
 
 class CharField(Field):
-    pass
+    def clean(self, value):
+        return value if isinstance(value, basestring) else INVALID
 
 
-class ArgumentsField(IterableField):
-    pass
+class ArgumentsField(Field):
+    def clean(self, value):
+        return value if isinstance(value, dict) else INVALID
 
 
 class EmailField(CharField):
-    def validate(self):
-        if not self.required and self.nullable and len(str(self.value)) == 0:
-            return True
-        return '@' in self.value
+    def clean(self, value):
+        return value if isinstance(value, basestring) and '@' in value else INVALID
 
 
 class PhoneField(Field):
     PHONE_LENGTH = 11
     PHONE_STARTS_WITH = '7'
 
-    def validate(self):
-        if not self.required and self.nullable and len(str(self.value)) == 0:
-            return True
-        return str(self.value).startswith(self.PHONE_STARTS_WITH) and len(str(self.value)) == self.PHONE_LENGTH
+    def clean(self, value):
+        if not isinstance(value, (basestring, int, long)) or isinstance(value, bool):
+            return INVALID
+        value = str(value)
+        if value.startswith(self.PHONE_STARTS_WITH) and len(value) == self.PHONE_LENGTH:
+            return value
+        return INVALID
 
 
 class DateField(Field):
     date_format = '%d.%m.%Y'
+    cache_suffix = '_parsed'
 
-    def validate(self):
+    def clean(self, value):
+        if not isinstance(value, basestring):
+            return INVALID
         try:
-            self.parse_date()
-            return True
-        except BaseException:
-            return False
-
-    def parse_date(self):
-        return datetime.datetime.strptime(self.value, self.date_format)
+            return datetime.datetime.strptime(value, self.date_format)
+        except ValueError:
+            return INVALID
 
 
 class BirthDayField(DateField):
     MAX_AGE = 70
 
-    def validate(self):
-        if not self.required and self.nullable and len(str(self)) == 0:
-            return True
-        if not super(BirthDayField, self).validate():
-            return False
-        date = self.parse_date()
-        age = self.age(date)
-        return age <= self.MAX_AGE
+    def clean(self, value):
+        date = super(BirthDayField, self).clean(value)
+        if date is INVALID or self.age(date) > self.MAX_AGE:
+            return INVALID
+        return date
 
     def age(self, date):
         today = datetime.date.today()
@@ -144,64 +168,90 @@ class BirthDayField(DateField):
 
 
 class GenderField(Field):
+    def clean(self, value):
+        if isinstance(value, bool) or not isinstance(value, (int, long)) or value not in GENDERS:
+            return INVALID
+        return value
 
-    def __str__(self):
-        return '' if self.value is None else str(self.value)
 
-    def validate(self):
-        if not self.required and self.nullable and len(str(self)) == 0:
-            return True
-        return self.value in GENDERS.keys()
-
-
-class ClientIDsField(IterableField):
-    def validate(self):
-        if not super(ClientIDsField, self).validate():
-            return False
-        if len(self.value) == 0:
-            return False
-        for val in self.value:
+class ClientIDsField(Field):
+    def clean(self, value):
+        if not isinstance(value, list):
+            return INVALID
+        for val in value:
             try:
                 int(val)
-            except ValueError:
-                return False
-        return True
+            except (TypeError, ValueError):
+                return INVALID
+        return value
+
+
+class RequestMeta(type):
+    """Moves Field attributes into __slots__ and compiles their validators."""
+
+    def __new__(mcs, name, bases, attrs):
+        fields = []
+        for base in bases:
+            fields.extend(getattr(base, 'fields', ()))
+        own_fields = [(attr, value) for attr, value in attrs.items() if isinstance(value, Field)]
+        own_fields.sort(key=lambda item: item[1].order)
+        slots = list(attrs.get('__slots__', ()))
+        for attr, field in own_fields:
+            del attrs[attr]
+            fields.append((attr, field.key or attr, field))
+            slots.append(attr)
+            if field.cache_suffix:
+                slots.append(attr + field.cache_suffix)
+        attrs['__slots__'] = tuple(slots)
+        attrs['fields'] = tuple(fields)
+        attrs['validators'] = tuple(
+            (attr, key, field.compile(), attr + field.cache_suffix if field.cache_suffix else None)
+            for attr, key, field in fields
+        )
+        return super(RequestMeta, mcs).__new__(mcs, name, bases, attrs)
 
 
 class BaseRequest(object):
-    fields = {}
-    is_admin = False
-    errors = ''
+    __metaclass__ = RequestMeta
+    __slots__ = ('is_admin', 'errors')
 
     def __init__(self, arguments):
-        for field_name, field in self.fields.items():
-            field.set_value(arguments[field_name] if field_name in arguments else None)
+        self.is_admin = False
+        self.errors = None
+        for attr, key, _, cache_slot in self.validators:
+            setattr(self, attr, arguments.get(key))
+            if cache_slot is not None:
+                setattr(self, cache_slot, None)
 
     def execute(self):
         self.validate()
         return self.execute_api()
 
     def validate(self):
+        if self.errors is not None:
+            return self.errors
         errors = ''
-        for field_name, field in self.fields.items():
-            if not field.validate():
-                errors += field_name + ' argument is incorrect. '
+        for attr, key, validator, cache_slot in self.validators:
+            cleaned = validator(getattr(self, attr))
+            if cleaned is INVALID:
+                errors += key + ' argument is incorrect. '
+            elif cache_slot is not None:
+                setattr(self, cache_slot, cleaned)
         errors += self.additional_validate()
         self.errors = errors
+        return errors
 
     def additional_validate(self):
         return ''
 
+    def non_empty_fields(self):
+        return [key for attr, key, _ in self.fields if not is_empty(getattr(self, attr))]
+
 
 class ClientsInterestsRequest(BaseRequest):
-    client_ids = ClientIDsField(required=True, nullable=False)
+    client_ids = ClientIDsField(required=True, nullable=False, key='clients_ids')
     date = DateField(required=False, nullable=True)
 
-    fields = {
-        'clients_ids': client_ids,
-        'date': date
-    }
-
 
 class OnlineScoreRequest(BaseRequest):
     first_name = CharField(required=False, nullable=True)
@@ -211,28 +261,15 @@ class OnlineScoreRequest(BaseRequest):
     birthday = BirthDayField(required=False, nullable=True)
     gender = GenderField(required=False, nullable=True)
 
-    needed_pairs = [
-        [phone, email],
-        [first_name, last_name],
-        [gender, birthday]
-    ]
-
-    fields = {
-        "first_name": first_name,
-        "last_name": last_name,
-        "email": email,
-        "phone": phone,
-        "birthday": birthday,
-        "gender": gender
-    }
+    needed_pairs = (
+        ('phone', 'email'),
+        ('first_name', 'last_name'),
+        ('gender', 'birthday'),
+    )
 
     def additional_validate(self):
-        for pair in self.needed_pairs:
-            pair_exist = True
-            for field in pair:
-                if field.empty():
-                    pair_exist = False
-            if pair_exist:
+        for first, second in self.needed_pairs:
+            if not is_empty(getattr(self, first)) and not is_empty(getattr(self, second)):
                 return ''
         return 'There is no required pair of values'
 
@@ -244,31 +281,26 @@ class MethodRequest(BaseRequest):
     arguments = ArgumentsField(required=True, nullable=True)
     method = CharField(required=True, nullable=False)
 
-    fields = {
-        'account': account,
-        'login': login,
-        'token': token,
-        'arguments': arguments,
-        'method': method
-    }
-
 
 class BaseRequestHandler(object):
 
-    def __init__(self, request):
+    def __init__(self, request, store=None):
         self.request = request
+        self.store = store
 
     def execute(self):
-        self.request.validate()
-        if len(self.request.errors) > 0:
-            return self.request.errors, INVALID_REQUEST
+        errors = self.request.validate()
+        if len(errors) > 0:
+            return errors, INVALID_REQUEST
 
+        started = time.time()
         store = self.get_store()
         result = self.get_result(store)
+        registry.observe("api_handler_duration_seconds", (("handler", type(self).__name__),), time.time() - started)
         return result, OK
 
     def get_store(self):
-        return None
+        return self.store
 
     def get_result(self, store):
         return None
@@ -276,16 +308,10 @@ class BaseRequestHandler(object):
 
 class ClientsInterestsRequestHandler(BaseRequestHandler):
 
-    def get_store(self):
-        return {
-            "nclients": self.request.client_ids.count()
-        }
-
     def get_result(self, store):
-        result = {}
-        for client_id in self.request.client_ids:
-            result[client_id] = get_interests(store, client_id)
-        return result
+        if interests_index is not None:
+            return interests_index.get_many(self.request.client_ids)
+        return get_interests_many(store, self.request.client_ids)
 
 
 class OnlineScoreRequestHandler(BaseRequestHandler):
@@ -299,22 +325,20 @@ class OnlineScoreRequestHandler(BaseRequestHandler):
         if self.request.is_admin:
             return {"score": 42}
         return {
-            "score": get_score(store, str(self.request.phone), str(self.request.email), str(self.request.birthday),
-                               str(self.request.gender), str(self.request.first_name), str(self.request.last_name))
+            "score": get_score(store, self.request.phone, self.request.email, self.request.birthday_parsed,
+                               not is_empty(self.request.gender), self.request.first_name, self.request.last_name)
         }
 
     def get_not_empty_fields(self):
-        not_empty_fields = []
-        for field_name, field in self.request.fields.items():
-            if field.count() > 0:
-                not_empty_fields.append(field_name)
+        return self.request.non_empty_fields()
 
 
 class AbstractRequestFactory(object):
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, arguments):
+    def __init__(self, arguments, store=None):
         self.arguments = arguments
+        self.store = store
 
     @abc.abstractmethod
     def create_request(self):
@@ -330,7 +354,7 @@ class OnlineScoreRequestFactory(AbstractRequestFactory):
         return OnlineScoreRequest(self.arguments)
 
     def create_handler(self, request):
-        return OnlineScoreRequestHandler(request)
+        return OnlineScoreRequestHandler(request, self.store)
 
 
 class ClientsInterestsRequestFactory(AbstractRequestFactory):
@@ -339,7 +363,7 @@ class ClientsInterestsRequestFactory(AbstractRequestFactory):
         return ClientsInterestsRequest(self.arguments)
 
     def create_handler(self, request):
-        return ClientsInterestsRequestHandler(request)
+        return ClientsInterestsRequestHandler(request, self.store)
 
 
 class MethodRequestHandler(BaseRequestHandler):
@@ -358,16 +382,16 @@ class MethodRequestHandler(BaseRequestHandler):
 
     def get_result(self, score):
         if self.request.method in self.REQUEST_METHOD:
-            request_factory = self.REQUEST_METHOD[self.request.method](self.request.arguments)
+            # empty arguments pass validation as nullable, non-empty ones are dicts
+            arguments = self.request.arguments if isinstance(self.request.arguments, dict) else {}
+            request_factory = self.REQUEST_METHOD[self.request.method](arguments, self.store)
             request = request_factory.create_request()
             request_handler = request_factory.create_handler(request)
             if self.is_admin:
                 request.is_admin = True
-            try:
-                return request_handler.execute()
-            except BaseException as e:
-                logging.exception(e.message)
-                return None, BAD_REQUEST
+            # invalid arguments come back as INVALID_REQUEST, anything raised
+            # is a server bug and reaches the 500 handler in handle_post
+            return request_handler.execute()
         else:
             return None, NOT_FOUND
 
@@ -378,23 +402,88 @@ class MethodRequestFactory(AbstractRequestFactory):
         return MethodRequest(self.arguments)
 
     def create_handler(self, request):
-        return MethodRequestHandler(request)
+        return MethodRequestHandler(request, self.store)
+
+
+rate_limiter = None
+idempotency_cache = None
+DEFAULT_TIMEOUT = 3.0
+default_timeout = DEFAULT_TIMEOUT
+interests_index = None
+authenticator = Authenticator(
+    SaltedTokenVerifier(SALT),
+    verifiers={ADMIN_LOGIN: HourlyTokenVerifier(ADMIN_SALT)},
+)
 
 
 def check_auth(request):
-    if request.login == ADMIN_LOGIN:
-        digest = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
-    else:
-        digest = hashlib.sha512(request.account + request.login + SALT).hexdigest()
-    if digest == request.token:
-        return True
-    return False
+    started = time.time()
+    result = authenticator.check(request)
+    registry.observe("api_auth_duration_seconds", (), time.time() - started)
+    return result
 
 
 def method_handler(request, ctx, store):
+    started = time.time()
+    body = request['body']
+    method = body.get('method') if isinstance(body, dict) else None
+    if method not in MethodRequestHandler.REQUEST_METHOD:
+        method = "unknown"
+    code = INTERNAL_ERROR
+    try:
+        if not isinstance(body, dict):
+            code = BAD_REQUEST
+            return None, code
+        login = body.get('login')
+        if rate_limiter is not None and isinstance(login, basestring) and not rate_limiter.allow(login):
+            registry.inc("api_shed_total", (("reason", "rate_limit"),))
+            code = TOO_MANY_REQUESTS
+            return None, code
+        deadline = request_deadline(request['headers'], started)
+        if store is not None and deadline is not None:
+            store = store.with_deadline(deadline)
+        request_id = request['headers'].get(REQUEST_ID_HEADER)
+        if idempotency_cache is not None and request_id and isinstance(login, basestring):
+            key = (request_id, login, body.get('token'))
+            try:
+                response, code = idempotency_cache.run(key, handle_method_request, (request, ctx, store),
+                                                       request_fingerprint(body))
+            except FingerprintMismatch:
+                code = INVALID_REQUEST
+                return REQUEST_ID_REUSED, code
+        else:
+            response, code = handle_method_request(request, ctx, store)
+        return response, code
+    finally:
+        labels = (("method", method),)
+        registry.observe("api_method_duration_seconds", labels, time.time() - started)
+        registry.inc("api_method_requests_total", labels + (("code", code),))
+
+
+def request_fingerprint(body):
+    """Hash of the method and arguments with keys in a canonical order."""
+    return hashlib.sha1(json.dumps(body, sort_keys=True, default=repr)).hexdigest()
+
+
+def request_deadline(headers, started):
+    """Absolute deadline from the client's timeout header (milliseconds),
+    capped by the server default."""
+    timeout = default_timeout
+    try:
+        client_timeout = float(headers.get(TIMEOUT_HEADER)) / 1000
+    except (TypeError, ValueError):
+        client_timeout = None
+    if client_timeout is not None and client_timeout > 0:
+        timeout = client_timeout if timeout is None else min(timeout, client_timeout)
+    return None if timeout is None else started + timeout
 
-    method_request_factory = MethodRequestFactory(request['body'])
+
+def handle_method_request(request, ctx, store):
+    method_request_factory = MethodRequestFactory(request['body'], store)
     method_request = method_request_factory.create_request()
+    errors = method_request.validate()
+    if len(errors) > 0:
+        return errors, INVALID_REQUEST
     if not check_auth(method_request):
         response, code = None, FORBIDDEN
         return response, code
@@ -407,24 +496,61 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
         "method": method_handler
     }
     store = None
+    request_logger = None
+    admission = None
+    max_body_size = 1024 * 1024
+    compress_min_size = 1024
 
     def get_request_id(self, headers):
-        return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
+        return headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.strip("/") != "metrics":
+            self.send_body(NOT_FOUND, ERROR_BODIES[JSON.content_type][NOT_FOUND])
+            return
+        self.send_body(OK, registry.render(), content_type=METRICS_CONTENT_TYPE)
 
     def do_POST(self):
+        started = time.time()
+        if self.admission is None:
+            return self.handle_post(started)
+        queue_wait = getattr(getattr(self.server, "local", None), "queue_wait", 0.0)
+        if not self.admission.try_acquire(queue_wait):
+            registry.inc("api_shed_total", (("reason", "overload"),))
+            self.close_connection = 1
+            codec = response_codec(self.headers.get('Accept'), request_codec(self.headers.get('Content-Type')) or JSON)
+            self.send_body(SERVICE_UNAVAILABLE, ERROR_BODIES[codec.content_type][SERVICE_UNAVAILABLE],
+                           codec.content_type)
+            return
+        try:
+            return self.handle_post(started)
+        finally:
+            self.admission.release()
+
+    def handle_post(self, started):
         response, code = {}, OK
         context = {"request_id": self.get_request_id(self.headers)}
         request = None
+        data_string = None
+        codec = request_codec(self.headers.get('Content-Type'))
         try:
-            data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
+            if codec is None:
+                codec = JSON
+                code = UNSUPPORTED_MEDIA_TYPE
+            else:
+                data_string = self.read_body()
+                request = codec.loads(data_string)
+        except BodyTooLarge:
+            code = REQUEST_ENTITY_TOO_LARGE
         except Exception as e:
             logging.exception(e.message)
             code = BAD_REQUEST
 
         if request:
             path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
             if path in self.router:
                 try:
                     response, code = self.router[path]({"body": request, "headers": self.headers}, context, self.store)
@@ -436,30 +562,164 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
         if code is None:
             code = NOT_FOUND
 
+        out_codec = response_codec(self.headers.get('Accept'), codec)
+        if code not in ERRORS:
+            body = out_codec.dumps({"response": response, "code": code})
+        elif not response:
+            body = ERROR_BODIES[out_codec.content_type].get(code)
+            if body is None:
+                body = out_codec.dumps({"error": "Unknown Error", "code": code})
+        else:
+            body = out_codec.dumps({"error": response, "code": code})
+        self.send_body(code, body, out_codec.content_type)
+        self.log_request_record(context, data_string and codec.log_body(data_string), code, response, started)
+        return
+
+    def read_body(self):
+        length = int(self.headers['Content-Length'])
+        if length > self.max_body_size:
+            self.close_connection = 1
+            raise BodyTooLarge(length)
+        return decode_body(self.rfile.read(length), self.headers.get('Content-Encoding'), self.max_body_size)
+
+    def send_body(self, code, body, content_type=JSON.content_type):
+        encoding = None
+        if len(body) >= self.compress_min_size:
+            encoding = choose_encoding(self.headers.get('Accept-Encoding'))
+        if encoding is not None:
+            body = encode_body(body, encoding)
         self.send_response(code)
-        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Vary", "Accept-Encoding")
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
         self.end_headers()
+        self.wfile.write(body)
+
+    def log_request_record(self, context, body, code, response, started):
+        if self.request_logger is None:
+            return
+        context["code"] = code
         if code not in ERRORS:
-            r = {"response": response, "code": code}
+            context["response"] = response
         else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
-        context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r))
-        return
+            context["error"] = response or ERRORS.get(code, "Unknown Error")
+        context["path"] = self.path
+        context["duration_ms"] = round((time.time() - started) * 1000, 3)
+        if body is not None:
+            context["body"] = body
+        self.request_logger.log(context, error=code != OK)
+
+
+class WorkerPoolHTTPServer(HTTPServer):
+    """Serves connections from a fixed pool of worker threads.
+
+    Accepted connections wait in a bounded queue together with the time
+    they were queued, and workers record how long each one waited in
+    server.local.queue_wait, so handlers can shed requests that waited
+    too long before doing any work. When the queue is full the accept
+    loop answers 503 right away and no worker is taken."""
+
+    def __init__(self, server_address, handler_class, workers=16, queue_size=128):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.local = threading.local()
+        self.requests = Queue.Queue(queue_size)
+        self.workers = []
+        for number in range(workers):
+            thread = threading.Thread(target=self.work, name="http-worker-%s" % number)
+            thread.daemon = True
+            thread.start()
+            self.workers.append(thread)
+
+    def process_request(self, request, client_address):
+        try:
+            self.requests.put_nowait((request, client_address, time.time()))
+        except Queue.Full:
+            registry.inc("api_shed_total", (("reason", "queue_full"),))
+            try:
+                request.sendall(QUEUE_FULL_RESPONSE)
+            except socket.error:
+                pass
+            self.shutdown_request(request)
+
+    def work(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            request, client_address, enqueued_at = item
+            self.local.queue_wait = time.time() - enqueued_at
+            registry.observe("api_queue_wait_seconds", (), self.local.queue_wait)
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        """Stops accepting and waits for queued and running requests."""
+        HTTPServer.server_close(self)
+        for _ in self.workers:
+            self.requests.put(None)
+        for thread in self.workers:
+            thread.join()
 
 
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-s", "--store", action="store", default=None, help="redis host:port")
+    op.add_option("--replica", action="append", default=[], help="redis replica host:port, may be repeated")
+    op.add_option("--interests-index", action="store", default=None,
+                  help="serve clients_interests from an index built with interests_index.py")
+    op.add_option("--timeout", action="store", type=float, default=DEFAULT_TIMEOUT,
+                  help="default request deadline in seconds, clients may lower it with X-Request-Timeout (ms)")
+    op.add_option("--log-sample-rate", action="store", type=float, default=1.0,
+                  help="share of successful requests to log, errors are always logged")
+    op.add_option("--log-body-size", action="store", type=int, default=1024)
+    op.add_option("--max-body-size", action="store", type=int, default=MainHTTPHandler.max_body_size)
+    op.add_option("--compress-min-size", action="store", type=int, default=MainHTTPHandler.compress_min_size)
+    op.add_option("--rate-limit", action="store", type=float, default=None, help="requests per second per login")
+    op.add_option("--rate-burst", action="store", type=float, default=None)
+    op.add_option("--workers", action="store", type=int, default=16)
+    op.add_option("--queue-size", action="store", type=int, default=128,
+                  help="connections waiting for a worker, more are answered with 503")
+    op.add_option("--max-in-flight", action="store", type=int, default=None)
+    op.add_option("--max-queue-wait", action="store", type=float, default=None, help="seconds")
+    op.add_option("--idempotency-ttl", action="store", type=float, default=None,
+                  help="seconds to replay responses for a repeated X-Request-ID")
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log, level=logging.INFO,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
+    if opts.store:
+        import redis
+
+        def redis_client(address):
+            host, _, port = address.partition(":")
+            return redis.StrictRedis(host=host, port=int(port or 6379))
+        MainHTTPHandler.store = Store(redis_client(opts.store), replicas=map(redis_client, opts.replica))
+    default_timeout = opts.timeout
+    if opts.interests_index:
+        interests_index = InterestsIndex(opts.interests_index)
+    MainHTTPHandler.max_body_size = opts.max_body_size
+    MainHTTPHandler.compress_min_size = opts.compress_min_size
+    MainHTTPHandler.request_logger = RequestLogger(sample_rate=opts.log_sample_rate,
+                                                   max_body_size=opts.log_body_size)
+    if opts.rate_limit:
+        rate_limiter = RateLimiter(opts.rate_limit, opts.rate_burst or opts.rate_limit)
+    if opts.idempotency_ttl:
+        idempotency_cache = IdempotencyCache(opts.idempotency_ttl,
+                                             cacheable=lambda result: result[1] not in RETRYABLE_CODES)
+    if opts.max_in_flight or opts.max_queue_wait:
+        MainHTTPHandler.admission = AdmissionController(opts.max_in_flight, opts.max_queue_wait)
+    server = WorkerPoolHTTPServer(("localhost", opts.port), MainHTTPHandler, opts.workers, opts.queue_size)
     logging.info("Starting server at %s" % opts.port)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         pass
     server.server_close()
+    MainHTTPHandler.request_logger.close()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import abc
+import datetime
+import hashlib
+import hmac
+import threading
+import time
+from collections import OrderedDict
+
+
+def to_bytes(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class LRUCache(object):
+    """Bounded thread-safe LRU set of keys."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            if key not in self.items:
+                return False
+            self.items[key] = self.items.pop(key)
+            return True
+
+    def add(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = True
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class TokenVerifier(object):
+    """Base verifier. Subclasses return the expected token for a request."""
+    __metaclass__ = abc.ABCMeta
+    cacheable = True
+
+    @abc.abstractmethod
+    def expected_token(self, request):
+        pass
+
+    def verify(self, request):
+        return hmac.compare_digest(self.expected_token(request), to_bytes(request.token))
+
+
+class SaltedTokenVerifier(TokenVerifier):
+
+    def __init__(self, salt):
+        self.salt = salt
+
+    def expected_token(self, request):
+        return hashlib.sha512(to_bytes(request.account) + to_bytes(request.login) + self.salt).hexdigest()
+
+
+class HourlyTokenVerifier(TokenVerifier):
+    """Token depends only on the current hour, so it is computed once per hour.
+    Results are not cached because they expire with the hour."""
+    cacheable = False
+
+    def __init__(self, salt, now=datetime.datetime.now):
+        self.salt = salt
+        self.now = now
+        self.token = None
+        self.expires_at = 0
+
+    def expected_token(self, request):
+        if time.time() >= self.expires_at:
+            self.refresh()
+        return self.token
+
+    def refresh(self):
+        now = self.now()
+        next_hour = now.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+        self.token = hashlib.sha512(now.strftime("%Y%m%d%H") + self.salt).hexdigest()
+        self.expires_at = time.time() + (next_hour - now).total_seconds()
+
+
+class Authenticator(object):
+    """Picks a verifier by login and remembers (account, login, token)
+    triples that were already verified successfully."""
+
+    def __init__(self, default_verifier, verifiers=None, cache_size=10000):
+        self.default_verifier = default_verifier
+        self.verifiers = verifiers or {}
+        self.cache = LRUCache(cache_size)
+
+    def check(self, request):
+        verifier = self.verifiers.get(request.login, self.default_verifier)
+        if not verifier.cacheable:
+            return verifier.verify(request)
+        key = (request.account, request.login, request.token)
+        if key in self.cache:
+            return True
+        if verifier.verify(request):
+            self.cache.add(key)
+            return True
+        return False
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import hashlib
+import httplib
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from optparse import OptionParser
+
+import transport
+from api import ADMIN_LOGIN, ADMIN_SALT, SALT
+
+FIRST_NAMES = ["Ivan", "Petr", "Anna", "Olga", "Maria"]
+LAST_NAMES = ["Ivanov", "Petrov", "Sidorova", "Smirnova"]
+
+
+def make_token(account, login):
+    """Builds the token the same way check_auth expects it."""
+    if login == ADMIN_LOGIN:
+        msg = datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT
+    else:
+        msg = account + login + SALT
+    return hashlib.sha512(msg).hexdigest()
+
+
+def online_score_arguments(rnd):
+    pair = rnd.randint(0, 2)
+    if pair == 0:
+        return {"phone": "7%010d" % rnd.randint(0, 10 ** 10 - 1), "email": "user%d@otus.ru" % rnd.randint(0, 10 ** 6)}
+    if pair == 1:
+        return {"first_name": rnd.choice(FIRST_NAMES), "last_name": rnd.choice(LAST_NAMES)}
+    birthday = datetime.date(rnd.randint(1960, 2005), rnd.randint(1, 12), rnd.randint(1, 28))
+    return {"gender": rnd.randint(0, 2), "birthday": birthday.strftime("%d.%m.%Y")}
+
+
+def clients_interests_arguments(rnd, max_clients=20):
+    arguments = {"clients_ids": [rnd.randint(1, 10 ** 6) for _ in range(rnd.randint(1, max_clients))]}
+    if rnd.random() < 0.5:
+        arguments["date"] = datetime.date.today().strftime("%d.%m.%Y")
+    return arguments
+
+
+ARGUMENT_BUILDERS = {
+    "online_score": online_score_arguments,
+    "clients_interests": clients_interests_arguments,
+}
+
+
+class RequestGenerator(object):
+    """Builds valid method requests according to a weighted method mix."""
+
+    def __init__(self, mix, admin_share=0.0, seed=None):
+        self.methods = sorted(mix)
+        self.cumulative_weights = self.accumulate([mix[method] for method in self.methods])
+        self.admin_share = admin_share
+        self.random = random.Random(seed)
+
+    @staticmethod
+    def accumulate(weights):
+        total, result = 0.0, []
+        for weight in weights:
+            total += weight
+            result.append(total)
+        return result
+
+    def choose_method(self):
+        point = self.random.random() * self.cumulative_weights[-1]
+        for method, bound in zip(self.methods, self.cumulative_weights):
+            if point < bound:
+                return method
+        return self.methods[-1]
+
+    def next_request(self):
+        method = self.choose_method()
+        account = "account%d" % self.random.randint(0, 100)
+        login = ADMIN_LOGIN if self.random.random() < self.admin_share else "login%d" % self.random.randint(0, 1000)
+        return {
+            "account": account,
+            "login": login,
+            "method": method,
+            "token": make_token(account, login),
+            "arguments": ARGUMENT_BUILDERS[method](self.random),
+        }
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = int(math.ceil(p / 100.0 * len(sorted_values))) - 1
+    return sorted_values[min(max(index, 0), len(sorted_values) - 1)]
+
+
+class LoadTest(object):
+
+    def __init__(self, host, port, concurrency, total_requests, mix, admin_share=0.0, seed=None, timeout=10,
+                 codec=transport.JSON):
+        self.host = host
+        self.port = port
+        self.concurrency = concurrency
+        self.total_requests = total_requests
+        self.mix = mix
+        self.admin_share = admin_share
+        self.seed = seed
+        self.timeout = timeout
+        self.codec = codec
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.codes = {}
+        self.errors = 0
+
+    def worker(self, worker_id):
+        seed = None if self.seed is None else self.seed + worker_id
+        generator = RequestGenerator(self.mix, self.admin_share, seed)
+        latencies, codes, errors = [], {}, 0
+        while next(self.counter) < self.total_requests:
+            body = self.codec.dumps(generator.next_request())
+            started = time.time()
+            try:
+                connection = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                connection.request("POST", "/method", body, {"Content-Type": self.codec.content_type})
+                response = connection.getresponse()
+                response.read()
+                connection.close()
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.time() - started)
+            codes[response.status] = codes.get(response.status, 0) + 1
+        with self.lock:
+            self.latencies.extend(latencies)
+            for code, count in codes.items():
+                self.codes[code] = self.codes.get(code, 0) + count
+            self.errors += errors
+
+    def run(self):
+        threads = [threading.Thread(target=self.worker, args=(i,)) for i in range(self.concurrency)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report(time.time() - started)
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+        to_ms = lambda value: None if value is None else round(value * 1000, 3)
+        return {
+            "config": {
+                "host": self.host,
+                "port": self.port,
+                "concurrency": self.concurrency,
+                "requests": self.total_requests,
+                "mix": self.mix,
+                "admin_share": self.admin_share,
+                "seed": self.seed,
+                "content_type": self.codec.content_type,
+            },
+            "elapsed_s": round(elapsed, 3),
+            "completed": len(latencies),
+            "errors": self.errors,
+            "codes": dict((str(code), count) for code, count in self.codes.items()),
+            "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+            "latency_ms": {
+                "p50": to_ms(percentile(latencies, 50)),
+                "p95": to_ms(percentile(latencies, 95)),
+                "p99": to_ms(percentile(latencies, 99)),
+                "max": to_ms(latencies[-1] if latencies else None),
+            },
+        }
+
+
+def codec_benchmark(count=10000, seed=None):
+    """Measures in-process encode/decode cost of every available codec
+    on the same generated requests and typical responses."""
+    generator = RequestGenerator({"online_score": 1, "clients_interests": 1}, seed=seed)
+    rnd = random.Random(seed)
+    requests = [generator.next_request() for _ in range(count)]
+    responses = []
+    for request in requests:
+        if request["method"] == "online_score":
+            responses.append({"response": {"score": rnd.choice([0, 1.5, 3.0, 5.0])}, "code": 200})
+        else:
+            ids = request["arguments"]["clients_ids"]
+            responses.append({"response": dict((cid, ["cars", "pets"]) for cid in ids), "code": 200})
+    report = {}
+    for codec in set(transport.CODECS.values()):
+        started = time.time()
+        encoded_requests = [codec.dumps(request) for request in requests]
+        encode_requests = time.time() - started
+        started = time.time()
+        for data in encoded_requests:
+            codec.loads(data)
+        decode_requests = time.time() - started
+        started = time.time()
+        encoded_responses = [codec.dumps(response) for response in responses]
+        encode_responses = time.time() - started
+        report[codec.content_type] = {
+            "request_bytes_avg": round(sum(map(len, encoded_requests)) / float(count), 1),
+            "response_bytes_avg": round(sum(map(len, encoded_responses)) / float(count), 1),
+            "request_decode_us": round(decode_requests / count * 1e6, 3),
+            "request_encode_us": round(encode_requests / count * 1e6, 3),
+            "response_encode_us": round(encode_responses / count * 1e6, 3),
+        }
+    return {"count": count, "codecs": report}
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(","):
+        method, _, weight = item.partition("=")
+        method = method.strip()
+        if method not in ARGUMENT_BUILDERS:
+            raise ValueError("Unknown method in mix: %s" % method)
+        mix[method] = float(weight or 1)
+    return mix
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("--host", action="store", default="localhost")
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-c", "--concurrency", action="store", type=int, default=4)
+    op.add_option("-n", "--requests", action="store", type=int, default=1000)
+    op.add_option("-m", "--mix", action="store", default="online_score=0.8,clients_interests=0.2")
+    op.add_option("--admin-share", action="store", type=float, default=0.0)
+    op.add_option("--seed", action="store", type=int, default=None)
+    op.add_option("-f", "--format", action="store", default=transport.JSON.content_type,
+                  help="request Content-Type, e.g. application/msgpack")
+    op.add_option("--codecs", action="store_true", default=False,
+                  help="only measure in-process encode/decode cost of the available codecs")
+    op.add_option("-o", "--output", action="store", default=None, help="write the JSON report to this file")
+    (opts, args) = op.parse_args()
+    if opts.codecs:
+        report = codec_benchmark(opts.requests, opts.seed)
+    else:
+        codec = transport.request_codec(opts.format)
+        if codec is None:
+            op.error("codec for %s is not installed" % opts.format)
+        load_test = LoadTest(opts.host, opts.port, opts.concurrency, opts.requests, parse_mix(opts.mix),
+                             opts.admin_share, opts.seed, codec=codec)
+        report = load_test.run()
+    result = json.dumps(report, indent=2, sort_keys=True)
+    if opts.output:
+        with open(opts.output, "w") as f:
+            f.write(result)
+    print result
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class FingerprintMismatch(Exception):
+    """The key was already used for a request with another fingerprint."""
+
+
+class Entry(object):
+    __slots__ = ('event', 'result', 'done', 'expires_at', 'fingerprint')
+
+    def __init__(self, fingerprint=None):
+        self.event = threading.Event()
+        self.result = None
+        self.done = False
+        self.expires_at = None
+        self.fingerprint = fingerprint
+
+
+class IdempotencyCache(object):
+    """Remembers results by key for `ttl` seconds.
+
+    The first caller for a key computes the result. Concurrent callers with
+    the same key wait for it instead of computing again. If the first call
+    raises or its result is not cacheable, nothing is stored and the waiters
+    compute the result themselves. A key reused with a different
+    fingerprint raises FingerprintMismatch instead of returning the
+    result of the other request."""
+
+    def __init__(self, ttl=60, max_size=10000, wait_timeout=None, cacheable=None, clock=time.time):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.wait_timeout = wait_timeout
+        self.cacheable = cacheable or (lambda result: True)
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def run(self, key, func, args=(), fingerprint=None):
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.done and entry.expires_at <= now:
+                del self.entries[key]
+                entry = None
+            owner = entry is None
+            if owner:
+                self.misses += 1
+                entry = self.entries[key] = Entry(fingerprint)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+            elif entry.fingerprint != fingerprint:
+                raise FingerprintMismatch(key)
+        if not owner:
+            entry.event.wait(self.wait_timeout)
+            if entry.done:
+                with self.lock:
+                    self.hits += 1
+                return entry.result
+            return func(*args)
+        try:
+            result = func(*args)
+        except Exception:
+            self.discard(key, entry)
+            entry.event.set()
+            raise
+        if self.cacheable(result):
+            entry.result = result
+            entry.expires_at = self.clock() + self.ttl
+            entry.done = True
+        else:
+            self.discard(key, entry)
+        entry.event.set()
+        return result
+
+    def discard(self, key, entry):
+        with self.lock:
+            if self.entries.get(key) is entry:
+                del self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
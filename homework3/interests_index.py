@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Read-only client interests index backed by a memory-mapped file.
+
+File layout (little-endian):
+    header   magic "IIDX", version (H), interests number (H), clients number (Q)
+    names    interest names, each as length (B) + utf-8 bytes, padded to 8 bytes
+    ids      sorted client ids, int64 each
+    masks    interest bitmasks in the same order as ids, uint32 each
+
+All processes that open the same file share its pages through the page cache.
+"""
+
+import mmap
+import struct
+from optparse import OptionParser
+
+from scoring import INTERESTS
+
+MAGIC = "IIDX"
+VERSION = 1
+HEADER = struct.Struct("<4sHHQ")
+ID = struct.Struct("<q")
+MASK = struct.Struct("<I")
+MAX_INTERESTS = MASK.size * 8
+
+
+class InterestsIndexError(Exception):
+    pass
+
+
+def pad8(size):
+    return (size + 7) & ~7
+
+
+def build(records, path, interests=INTERESTS):
+    """Writes (client_id, [interest, ...]) records into an index file."""
+    if len(interests) > MAX_INTERESTS:
+        raise InterestsIndexError("At most %s interests fit into a mask" % MAX_INTERESTS)
+    bits = dict((name, 1 << i) for i, name in enumerate(interests))
+    masks_by_id = {}
+    for cid, names in records:
+        cid = int(cid)
+        if cid in masks_by_id:
+            raise InterestsIndexError("Duplicate client id %s" % cid)
+        mask = 0
+        for name in names:
+            if name not in bits:
+                raise InterestsIndexError("Unknown interest %r for client %s" % (name, cid))
+            mask |= bits[name]
+        masks_by_id[cid] = mask
+    ids = sorted(masks_by_id)
+    names_block = "".join(struct.pack("B", len(name)) + name for name in (n.encode("utf-8") for n in interests))
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(interests), len(ids)))
+        f.write(names_block + "\0" * (pad8(HEADER.size + len(names_block)) - HEADER.size - len(names_block)))
+        f.write(struct.pack("<%dq" % len(ids), *ids))
+        f.write(struct.pack("<%dI" % len(ids), *(masks_by_id[cid] for cid in ids)))
+    return len(ids)
+
+
+def read_records(lines):
+    """Parses "client_id<TAB>interest,interest" lines."""
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        cid, _, names = line.partition("\t")
+        yield cid, [name.strip().decode("utf-8") for name in names.split(",") if name.strip()]
+
+
+class InterestsIndex(object):
+    """Looks client ids up with a binary search directly over the mapped file."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, interests_number, self.count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise InterestsIndexError("Unsupported index file %s (magic %r, version %s)" % (path, magic, version))
+        offset = HEADER.size
+        self.interests = []
+        for _ in range(interests_number):
+            size = ord(self.mm[offset])
+            self.interests.append(self.mm[offset + 1:offset + 1 + size].decode("utf-8"))
+            offset += 1 + size
+        self.ids_offset = pad8(offset)
+        self.masks_offset = self.ids_offset + self.count * ID.size
+        if self.masks_offset + self.count * MASK.size > len(self.mm):
+            raise InterestsIndexError("Truncated index file %s" % path)
+        self.decoded = {}
+
+    def close(self):
+        self.mm.close()
+
+    def __len__(self):
+        return self.count
+
+    def find(self, cid):
+        """Position of cid in the id array or -1."""
+        unpack_from, mm, ids_offset = ID.unpack_from, self.mm, self.ids_offset
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            value = unpack_from(mm, ids_offset + mid * ID.size)[0]
+            if value < cid:
+                lo = mid + 1
+            elif value > cid:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def decode(self, mask):
+        names = self.decoded.get(mask)
+        if names is None:
+            names = self.decoded[mask] = [name for i, name in enumerate(self.interests) if mask & (1 << i)]
+        return list(names)
+
+    def get(self, cid):
+        position = self.find(int(cid))
+        if position < 0:
+            return []
+        return self.decode(MASK.unpack_from(self.mm, self.masks_offset + position * MASK.size)[0])
+
+    def get_many(self, cids):
+        result = {}
+        for cid in cids:
+            if cid not in result:
+                result[cid] = self.get(cid)
+        return result
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog build SOURCE INDEX\n\nSOURCE has one \"client_id<TAB>interest,interest\" per line.")
+    (opts, args) = op.parse_args()
+    if len(args) != 3 or args[0] != "build":
+        op.error("expected: build SOURCE INDEX")
+    with open(args[1]) as source:
+        written = build(read_records(source), args[2])
+    print "%s clients written to %s" % (written, args[2])
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import random
+import threading
+import Queue
+
+
+class RequestLogger(object):
+    """Writes structured request records from a background thread.
+
+    Success records are sampled with sample_rate, error records are always
+    queued. Bodies longer than max_body_size are truncated. close() drains
+    the queue, so nothing already accepted is lost on a clean shutdown.
+    Records logged after close() (e.g. by request threads still running)
+    are written synchronously by the calling thread."""
+
+    STOP = object()
+
+    def __init__(self, logger=None, sample_rate=1.0, max_body_size=1024, queue_size=10000):
+        self.logger = logger or logging.getLogger("api.requests")
+        self.sample_rate = sample_rate
+        self.max_body_size = max_body_size
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        self.closed = False
+        # orders log() against close(), so no record lands behind STOP
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="request-logger")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def log(self, record, error=False):
+        if not error and self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        body = record.get("body")
+        if body is not None and len(body) > self.max_body_size:
+            record["body"] = body[:self.max_body_size]
+            record["body_truncated"] = len(body)
+        with self.lock:
+            if not self.closed:
+                try:
+                    if error:
+                        self.queue.put(record)
+                    else:
+                        self.queue.put_nowait(record)
+                except Queue.Full:
+                    self.dropped += 1
+                return
+        self.write(record)
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is self.STOP:
+                break
+            self.write(record)
+
+    def write(self, record):
+        try:
+            self.logger.info(json.dumps(record, default=str))
+        except Exception:
+            logging.exception("Failed to write request log record")
+
+    def close(self, timeout=None):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(self.STOP)
+        self.thread.join(timeout)
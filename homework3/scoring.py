@@ -1,5 +1,8 @@
+import json
 import random
 
+INTERESTS = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
+
 
 def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
     score = 0
@@ -14,6 +17,28 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
     return score
 
 
+def interests_key(cid):
+    return "i:%s" % cid
+
+
 def get_interests(store, cid):
-    interests = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
-    return random.sample(interests, 2)
+    return get_interests_many(store, [cid])[cid]
+
+
+def get_interests_many(store, cids):
+    """Fetches interests for all client ids with a single store round trip.
+    Repeated ids are looked up once, missing ids get an empty list."""
+    unique_cids = []
+    seen = set()
+    for cid in cids:
+        if cid not in seen:
+            seen.add(cid)
+            unique_cids.append(cid)
+    if store is None:
+        return dict((cid, random.sample(INTERESTS, 2)) for cid in unique_cids)
+    values = store.get_many(interests_key(cid) for cid in unique_cids)
+    result = {}
+    for cid in unique_cids:
+        raw = values.get(interests_key(cid))
+        result[cid] = json.loads(raw) if raw else []
+    return result
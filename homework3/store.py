@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import itertools
+import logging
+import threading
+import time
+import Queue
+from collections import OrderedDict, deque
+
+from metrics import registry
+
+
+class StoreError(Exception):
+    pass
+
+
+class DeadlineExceeded(StoreError):
+    pass
+
+
+class StaleCache(object):
+    """Bounded LRU of the last values read from the store."""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def update(self, values):
+        with self.lock:
+            for key, value in values.iteritems():
+                self.items.pop(key, None)
+                self.items[key] = value
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def get_many(self, keys):
+        with self.lock:
+            return dict((key, self.items[key]) for key in keys if key in self.items)
+
+
+class LatencyTracker(object):
+    """Keeps recent call latencies and derives the hedge delay from them."""
+
+    def __init__(self, percentile=95, window=512, refresh_every=64, initial_delay=0.05, min_delay=0.002):
+        self.percentile = percentile
+        self.samples = deque(maxlen=window)
+        self.refresh_every = refresh_every
+        self.min_delay = min_delay
+        self.delay = initial_delay
+        self.counter = itertools.count(1)
+
+    def observe(self, latency):
+        self.samples.append(latency)
+        if next(self.counter) % self.refresh_every == 0:
+            samples = sorted(self.samples)
+            index = min(len(samples) - 1, int(len(samples) * self.percentile / 100.0))
+            self.delay = max(self.min_delay, samples[index])
+
+
+class WorkerPool(object):
+    """Fixed set of daemon threads, started on the first submitted call."""
+
+    def __init__(self, size):
+        self.size = size
+        self.tasks = Queue.Queue()
+        self.started = False
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args):
+        if not self.started:
+            self.start()
+        self.tasks.put((func, args))
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            for number in range(self.size):
+                thread = threading.Thread(target=self.work, name="store-worker-%s" % number)
+                thread.daemon = True
+                thread.start()
+            self.started = True
+
+    def work(self):
+        while True:
+            func, args = self.tasks.get()
+            func(*args)
+
+
+class Store(object):
+    """Wrapper over redis-compatible clients: a primary and optional replicas.
+
+    Calls respect an absolute deadline, or give up after timeout seconds
+    when the caller has none, so a hung client never holds a thread for
+    good. With a single client calls
+    run in the caller's thread and the deadline is checked before each
+    attempt. With replicas, calls run in a small worker pool: a read that
+    has not answered within the recent latency percentile is hedged to the
+    next replica and the first answer wins. Reads that fail or run out of
+    time fall back to the last values seen for those keys."""
+
+    def __init__(self, client, replicas=None, retries=3, hedge_percentile=95, stale_cache_size=100000,
+                 hedge_workers=8, timeout=5.0):
+        self.clients = [client] + list(replicas or [])
+        self.retries = max(retries, len(self.clients))
+        self.latency = LatencyTracker(hedge_percentile)
+        self.stale = StaleCache(stale_cache_size)
+        self.next_client = itertools.count()
+        self.pool = WorkerPool(hedge_workers)
+        self.timeout = timeout
+
+    def with_deadline(self, deadline):
+        return DeadlineStore(self, deadline)
+
+    def get(self, key, deadline=None):
+        return self.get_many([key], deadline).get(key)
+
+    def get_many(self, keys, deadline=None):
+        """Fetches all keys in one pipelined round trip.
+        Only keys present in the store are returned, or those present in
+        the stale cache if the store could not answer in time."""
+        keys = list(keys)
+        if len(keys) == 0:
+            return {}
+        try:
+            values = self.timed("get_many", pipelined_get, keys, deadline)
+        except StoreError as e:
+            logging.warning("Serving stale values for %s keys: %s" % (len(keys), e))
+            registry.inc("store_degraded_total", (("op", "get_many"),))
+            return self.stale.get_many(keys)
+        result = dict((key, value) for key, value in zip(keys, values) if value is not None)
+        self.stale.update(result)
+        return result
+
+    def timed(self, op, func, *args):
+        started = time.time()
+        try:
+            return self.call(func, *args)
+        except StoreError as e:
+            reason = "deadline" if isinstance(e, DeadlineExceeded) else "error"
+            registry.inc("store_errors_total", (("op", op), ("reason", reason)))
+            raise
+        finally:
+            registry.observe("store_call_duration_seconds", (("op", op),), time.time() - started)
+
+    def call(self, func, keys, deadline):
+        if deadline is None:
+            deadline = time.time() + self.timeout
+        if len(self.clients) == 1:
+            return self.call_inline(func, keys, deadline)
+        return self.call_hedged(func, keys, deadline)
+
+    def call_inline(self, func, keys, deadline):
+        for attempt in range(1, self.retries + 1):
+            started = time.time()
+            if deadline is not None and started >= deadline:
+                raise DeadlineExceeded("deadline exceeded after %s attempts" % (attempt - 1))
+            try:
+                result = func(self.clients[0], keys)
+            except Exception as e:
+                logging.warning("Store call failed (attempt %s of %s): %s" % (attempt, self.retries, e))
+                if attempt == self.retries:
+                    raise StoreError(str(e))
+                continue
+            self.latency.observe(time.time() - started)
+            return result
+
+    def call_hedged(self, func, keys, deadline):
+        results = Queue.Queue()
+        first = next(self.next_client)
+        launched, failed = 0, 0
+        while True:
+            if launched == failed:
+                # nothing in flight: first attempt or retry after a failure
+                self.launch(func, self.clients[(first + launched) % len(self.clients)], keys, results)
+                launched += 1
+            can_hedge = launched < self.retries and launched < len(self.clients)
+            timeout = self.latency.delay if can_hedge else None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise DeadlineExceeded("deadline exceeded after %s attempts" % launched)
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            try:
+                ok, value, latency = results.get(timeout=timeout)
+            except Queue.Empty:
+                if can_hedge:
+                    registry.inc("store_hedged_total")
+                    self.launch(func, self.clients[(first + launched) % len(self.clients)], keys, results)
+                    launched += 1
+                continue
+            if ok:
+                self.latency.observe(latency)
+                return value
+            failed += 1
+            logging.warning("Store call failed (attempt %s of %s): %s" % (failed, self.retries, value))
+            if failed >= self.retries:
+                raise StoreError(str(value))
+
+    def launch(self, func, client, keys, results):
+        def run():
+            started = time.time()
+            try:
+                results.put((True, func(client, keys), time.time() - started))
+            except Exception as e:
+                results.put((False, e, time.time() - started))
+        self.pool.submit(run)
+
+
+class DeadlineStore(object):
+    """Store view bound to the deadline of one request."""
+
+    def __init__(self, store, deadline):
+        self.store = store
+        self.deadline = deadline
+
+    def get(self, key):
+        return self.store.get(key, self.deadline)
+
+    def get_many(self, keys):
+        return self.store.get_many(keys, self.deadline)
+
+
+def pipelined_get(client, keys):
+    pipeline = client.pipeline(transaction=False)
+    for key in keys:
+        pipeline.get(key)
+    return pipeline.execute()
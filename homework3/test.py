@@ -1,6 +1,93 @@
+import datetime
+import hashlib
+import httplib
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler
 
+import admission
 import api
+import bench
+import idempotency
+import interests_index
+import metrics
+import scoring
+import transport
+from request_log import RequestLogger
+from store import Store
+
+
+class ListLogger(object):
+    def __init__(self):
+        self.lines = []
+
+    def info(self, line):
+        self.lines.append(json.loads(line))
+
+
+class FakePipeline(object):
+    def __init__(self, client):
+        self.client = client
+        self.keys = []
+
+    def get(self, key):
+        self.keys.append(key)
+
+    def execute(self):
+        self.client.round_trips += 1
+        time.sleep(self.client.delay)
+        return [self.client.data.get(key) for key in self.keys]
+
+
+class FakeRedis(object):
+    def __init__(self, data, delay=0):
+        self.data = data
+        self.delay = delay
+        self.round_trips = 0
+
+    def get(self, key):
+        self.round_trips += 1
+        return self.data.get(key)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    queue_waits = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.queue_waits.append(self.server.local.queue_wait)
+        time.sleep(0.2)
+        self.send_response(api.OK)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server.server_address[1]
+
+
+def http_status(port, results, method="GET", body=None, headers=None):
+    connection = httplib.HTTPConnection("localhost", port, timeout=5)
+    try:
+        connection.request(method, "/", body, headers or {})
+        response = connection.getresponse()
+        results.append((response.status, response.getheader("Content-Type"), response.read()))
+    except (httplib.HTTPException, IOError):
+        results.append((None, None, None))
+    finally:
+        connection.close()
 
 
 class TestSuite(unittest.TestCase):
@@ -12,10 +99,311 @@ class TestSuite(unittest.TestCase):
     def get_response(self, request):
         return api.method_handler({"body": request, "headers": self.headers}, self.context, self.store)
 
+    def set_valid_auth(self, request):
+        if request.get("login") == api.ADMIN_LOGIN:
+            msg = datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT
+        else:
+            msg = request.get("account", "") + request.get("login", "") + api.SALT
+        request["token"] = hashlib.sha512(msg).hexdigest()
+
     def test_empty_request(self):
         _, code = self.get_response({})
         self.assertEqual(api.INVALID_REQUEST, code)
 
+    def test_non_object_request(self):
+        self.assertEqual(api.BAD_REQUEST, self.get_response([1, 2])[1])
+        for arguments in (None, [], "", 5):
+            request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": arguments}
+            self.set_valid_auth(request)
+            self.assertEqual(api.INVALID_REQUEST, self.get_response(request)[1])
+
+    def test_invalid_online_score_arguments(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"phone": "89175002040", "email": "stupnikov.otus.ru"}}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.INVALID_REQUEST, code)
+        self.assertIn("phone argument is incorrect. ", response)
+        self.assertIn("email argument is incorrect. ", response)
+
+    def test_ok_online_score(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"gender": 1, "birthday": "01.01.2000", "first_name": "a"}}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(1.5, response["score"])
+
+    def test_online_score_unknown_gender(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"gender": 0, "birthday": "01.01.2000"}}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(1.5, response["score"])
+
+    def test_online_score_unhashable_gender(self):
+        for gender in ([1], {"a": 1}):
+            request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                       "arguments": {"gender": gender, "birthday": "01.01.2000"}}
+            self.set_valid_auth(request)
+            response, code = self.get_response(request)
+            self.assertEqual(api.INVALID_REQUEST, code)
+            self.assertIn("gender argument is incorrect. ", response)
+
+    def test_requests_do_not_share_state(self):
+        first = api.OnlineScoreRequest({"birthday": "01.01.2000", "gender": 1})
+        second = api.OnlineScoreRequest({"phone": "79175002040"})
+        self.assertEqual("", first.validate())
+        self.assertEqual(datetime.datetime(2000, 1, 1), first.birthday_parsed)
+        self.assertIsNone(second.birthday)
+        self.assertEqual("There is no required pair of values", second.validate())
+
+    def test_auth_cache(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        self.set_valid_auth(request)
+        api.authenticator.cache.clear()
+        self.assertEqual(api.OK, self.get_response(request)[1])
+        self.assertEqual(1, len(api.authenticator.cache))
+        self.assertEqual(api.OK, self.get_response(request)[1])
+        request["token"] = "0" * 128
+        self.assertEqual(api.FORBIDDEN, self.get_response(request)[1])
+
+    def test_admin_score(self):
+        request = {"account": "horns&hoofs", "login": "admin", "method": "online_score",
+                   "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(42, response["score"])
+
+    def test_get_interests_many_single_round_trip(self):
+        client = FakeRedis({
+            scoring.interests_key(1): json.dumps(["cars", "pets"]),
+            scoring.interests_key(2): json.dumps(["books"]),
+        })
+        interests = scoring.get_interests_many(Store(client), [1, 2, 1, 3, 2])
+        self.assertEqual(1, client.round_trips)
+        self.assertEqual({1: ["cars", "pets"], 2: ["books"], 3: []}, interests)
+
+    def test_request_logger_samples_success_and_keeps_errors(self):
+        sink = ListLogger()
+        request_logger = RequestLogger(sink, sample_rate=0.0, max_body_size=4)
+        for _ in range(10):
+            request_logger.log({"code": api.OK, "body": "{}"})
+        request_logger.log({"code": api.INVALID_REQUEST, "body": "0123456789"}, error=True)
+        request_logger.close()
+        self.assertEqual([{"code": api.INVALID_REQUEST, "body": "0123", "body_truncated": 10}], sink.lines)
+
+    def test_request_logger_writes_after_close(self):
+        sink = ListLogger()
+        request_logger = RequestLogger(sink)
+        request_logger.log({"code": api.OK})
+        request_logger.close()
+        request_logger.log({"code": api.NOT_FOUND}, error=True)
+        self.assertEqual([{"code": api.OK}, {"code": api.NOT_FOUND}], sink.lines)
+
+    def test_compressed_body_round_trip(self):
+        body = json.dumps({"clients_ids": range(1000)})
+        for encoding in transport.SUPPORTED_ENCODINGS:
+            compressed = transport.encode_body(body, encoding)
+            self.assertLess(len(compressed), len(body))
+            self.assertEqual(body, transport.decode_body(compressed, encoding, len(body)))
+            with self.assertRaises(transport.BodyTooLarge):
+                transport.decode_body(compressed, encoding, len(body) - 1)
+
+    def test_choose_encoding(self):
+        self.assertEqual("gzip", transport.choose_encoding("deflate;q=0.5, gzip"))
+        self.assertEqual("deflate", transport.choose_encoding("gzip;q=0, deflate, br"))
+        self.assertIsNone(transport.choose_encoding("br"))
+
+    def test_method_metrics(self):
+        metrics.registry.clear()
+        self.get_response({"login": "h&f", "token": "", "method": "online_score", "arguments": {}})
+        self.get_response({"login": "h&f", "token": "", "method": "foo", "arguments": {}})
+        self.assertEqual(1, metrics.registry.counter_value(
+            "api_method_requests_total", (("method", "online_score"), ("code", api.FORBIDDEN))))
+        self.assertEqual(1, metrics.registry.counter_value(
+            "api_method_requests_total", (("method", "unknown"), ("code", api.FORBIDDEN))))
+        rendered = metrics.registry.render()
+        self.assertIn('api_method_duration_seconds_count{method="online_score"} 1', rendered)
+        self.assertIn('api_method_duration_seconds_bucket{method="unknown",le="+Inf"} 1', rendered)
+
+    def test_bench_generates_valid_requests(self):
+        generator = bench.RequestGenerator({"online_score": 1, "clients_interests": 1}, admin_share=0.2, seed=1)
+        for _ in range(50):
+            _, code = self.get_response(generator.next_request())
+            self.assertEqual(api.OK, code)
+        self.assertEqual(3, bench.percentile([1, 2, 3, 4], 75))
+
+    def test_rate_limit_sheds_before_validation(self):
+        clock = [0.0]
+        api.rate_limiter = admission.RateLimiter(rate=1, burst=2, clock=lambda: clock[0])
+        try:
+            request = {"login": "h&f", "method": "online_score"}
+            codes = [self.get_response(request)[1] for _ in range(3)]
+            self.assertEqual([api.INVALID_REQUEST, api.INVALID_REQUEST, api.TOO_MANY_REQUESTS], codes)
+            clock[0] += 1
+            self.assertEqual(api.INVALID_REQUEST, self.get_response(request)[1])
+        finally:
+            api.rate_limiter = None
+
+    def test_admission_controller(self):
+        controller = admission.AdmissionController(max_in_flight=1, max_queue_wait=0.5)
+        self.assertFalse(controller.try_acquire(queue_wait=1.0))
+        self.assertTrue(controller.try_acquire())
+        self.assertFalse(controller.try_acquire())
+        controller.release()
+        self.assertTrue(controller.try_acquire())
+
+    def test_worker_pool_queues_and_sheds(self):
+        SlowHandler.queue_waits = []
+        server = api.WorkerPoolHTTPServer(("localhost", 0), SlowHandler, workers=1, queue_size=1)
+        port = serve(server)
+        try:
+            results = []
+            threads = [threading.Thread(target=http_status, args=(port, results)) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+                time.sleep(0.05)
+            for thread in threads:
+                thread.join()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual([api.OK, api.OK, api.SERVICE_UNAVAILABLE], sorted(status for status, _, _ in results))
+        self.assertEqual(2, len(SlowHandler.queue_waits))
+        self.assertGreater(max(SlowHandler.queue_waits), 0.1)
+
+    @unittest.skipIf(transport.MSGPACK is None, "msgpack is not installed")
+    def test_overload_shed_uses_request_codec(self):
+        api.MainHTTPHandler.admission = admission.AdmissionController(max_in_flight=0)
+        server = api.WorkerPoolHTTPServer(("localhost", 0), api.MainHTTPHandler, workers=1)
+        port = serve(server)
+        try:
+            results = []
+            http_status(port, results, "POST", transport.MSGPACK.dumps({}),
+                        {"Content-Type": transport.MSGPACK.content_type})
+        finally:
+            server.shutdown()
+            server.server_close()
+            api.MainHTTPHandler.admission = None
+        status, content_type, body = results[0]
+        self.assertEqual(api.SERVICE_UNAVAILABLE, status)
+        self.assertEqual(transport.MSGPACK.content_type, content_type)
+        self.assertEqual(api.SERVICE_UNAVAILABLE, transport.MSGPACK.loads(body)["code"])
+
+    def test_idempotent_replay(self):
+        api.idempotency_cache = idempotency.IdempotencyCache(ttl=60)
+        try:
+            self.headers = {api.REQUEST_ID_HEADER: "req-1"}
+            request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                       "arguments": {"clients_ids": [1, 2]}}
+            self.set_valid_auth(request)
+            first = self.get_response(request)
+            self.assertEqual(first, self.get_response(request))
+            self.assertEqual(1, api.idempotency_cache.hits)
+            self.headers = {api.REQUEST_ID_HEADER: "req-2"}
+            self.get_response(request)
+            self.assertEqual(2, api.idempotency_cache.misses)
+            request["arguments"]["clients_ids"] = [3]
+            self.assertEqual((api.REQUEST_ID_REUSED, api.INVALID_REQUEST), self.get_response(request))
+            request["method"] = "online_score"
+            self.assertEqual(api.INVALID_REQUEST, self.get_response(request)[1])
+            self.assertEqual(2, api.idempotency_cache.misses)
+        finally:
+            api.idempotency_cache = None
+
+    def test_idempotency_waits_for_in_flight_call(self):
+        cache = idempotency.IdempotencyCache(ttl=60)
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.05)
+            return len(calls)
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.run("k", slow, (), "f"))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(calls))
+        self.assertEqual([1] * 5, results)
+
+    @unittest.skipIf(transport.MSGPACK is None, "msgpack is not installed")
+    def test_msgpack_matches_json(self):
+        response = {"response": {1: ["cars", "pets"], 2: []}, "code": api.OK}
+        self.assertEqual(transport.JSON.loads(transport.JSON.dumps(response)),
+                         transport.MSGPACK.loads(transport.MSGPACK.dumps(response)))
+        self.assertIs(transport.MSGPACK, transport.request_codec("application/x-msgpack; charset=binary"))
+        self.assertIs(transport.JSON, transport.request_codec(None))
+        self.assertIs(transport.MSGPACK, transport.response_codec("application/msgpack", transport.JSON))
+
+    def test_hedged_read_skips_slow_replica(self):
+        data = {scoring.interests_key(1): json.dumps(["cars"])}
+        slow, fast = FakeRedis(data, delay=1), FakeRedis(data)
+        store = Store(slow, replicas=[fast])
+        store.latency.delay = 0.01
+        started = time.time()
+        self.assertEqual({1: ["cars"]}, scoring.get_interests_many(store.with_deadline(started + 0.5), [1]))
+        self.assertLess(time.time() - started, 0.5)
+        self.assertEqual(1, fast.round_trips)
+
+    def test_deadline_serves_stale_values(self):
+        client = FakeRedis({scoring.interests_key(1): json.dumps(["cars"])})
+        store = Store(client)
+        self.assertEqual({1: ["cars"]}, scoring.get_interests_many(store, [1]))
+        threads = threading.active_count()
+        interests = scoring.get_interests_many(store.with_deadline(time.time() - 1), [1, 2])
+        self.assertEqual({1: ["cars"], 2: []}, interests)
+        self.assertEqual(1, client.round_trips)
+        self.assertEqual(1, len(scoring.get_interests_many(store.with_deadline(time.time() + 1), [1])))
+        self.assertEqual(2, client.round_trips)
+        self.assertEqual(threads, threading.active_count())
+
+    def test_request_deadline(self):
+        api.default_timeout = 2.0
+        try:
+            self.assertEqual(12.0, api.request_deadline({}, 10.0))
+            self.assertEqual(10.5, api.request_deadline({api.TIMEOUT_HEADER: "500"}, 10.0))
+            self.assertEqual(12.0, api.request_deadline({api.TIMEOUT_HEADER: "junk"}, 10.0))
+            api.default_timeout = None
+            self.assertIsNone(api.request_deadline({}, 10.0))
+        finally:
+            api.default_timeout = api.DEFAULT_TIMEOUT
+
+    def test_store_timeout_without_deadline(self):
+        data = {scoring.interests_key(1): json.dumps(["cars"])}
+        store = Store(FakeRedis(data), replicas=[FakeRedis(data)], retries=1, timeout=0.1)
+        self.assertEqual({1: ["cars"]}, scoring.get_interests_many(store, [1]))
+        for client in store.clients:
+            client.delay = 1
+        started = time.time()
+        self.assertEqual({1: ["cars"]}, scoring.get_interests_many(store, [1]))
+        self.assertLess(time.time() - started, 0.5)
+
+    def test_interests_index(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        index = None
+        try:
+            lines = ["# client\tinterests", "7\tcars,otus", "3\t", "-5\tbooks"]
+            self.assertEqual(3, interests_index.build(interests_index.read_records(lines), path))
+            index = interests_index.InterestsIndex(path)
+            api.interests_index = index
+            request = api.ClientsInterestsRequest({"clients_ids": [7, 3, "-5", 100, 7]})
+            result, code = api.ClientsInterestsRequestHandler(request).execute()
+            self.assertEqual(api.OK, code)
+            self.assertEqual({7: ["cars", "otus"], 3: [], "-5": ["books"], 100: []}, result)
+        finally:
+            api.interests_index = None
+            if index is not None:
+                index.close()
+            os.remove(path)
+
 
 if __name__ == "__main__":
     unittest.main()
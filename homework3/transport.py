@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import base64
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+GZIP = "gzip"
+DEFLATE = "deflate"
+IDENTITY = "identity"
+SUPPORTED_ENCODINGS = (GZIP, DEFLATE)
+
+WBITS = {
+    GZIP: 16 + zlib.MAX_WBITS,
+    DEFLATE: zlib.MAX_WBITS,
+}
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+def decode_body(data, content_encoding, max_size):
+    """Decompresses a request body, refusing to inflate past max_size."""
+    encoding = (content_encoding or IDENTITY).strip().lower()
+    if encoding == IDENTITY:
+        if len(data) > max_size:
+            raise BodyTooLarge(len(data))
+        return data
+    if encoding not in WBITS:
+        raise ValueError("Unsupported Content-Encoding: %s" % content_encoding)
+    try:
+        return inflate(data, WBITS[encoding], max_size)
+    except zlib.error:
+        if encoding != DEFLATE:
+            raise
+        # some clients send raw deflate streams without the zlib header
+        return inflate(data, -zlib.MAX_WBITS, max_size)
+
+
+def inflate(data, wbits, max_size):
+    decompressor = zlib.decompressobj(wbits)
+    result = decompressor.decompress(data, max_size + 1)
+    if len(result) > max_size or decompressor.unconsumed_tail:
+        raise BodyTooLarge(max_size)
+    result += decompressor.flush()
+    if len(result) > max_size:
+        raise BodyTooLarge(max_size)
+    return result
+
+
+def encode_body(data, encoding, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+
+def choose_encoding(accept_encoding):
+    """Picks the preferred supported encoding from an Accept-Encoding header."""
+    if not accept_encoding:
+        return None
+    best, best_q = None, 0.0
+    for item in accept_encoding.split(","):
+        parts = item.strip().split(";")
+        name = parts[0].strip().lower()
+        if name not in SUPPORTED_ENCODINGS:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+def error_bodies(errors, dumps=json.dumps):
+    """Pre-serializes the default error responses once at import time."""
+    return dict((code, dumps({"error": message, "code": code})) for code, message in errors.items())
+
+
+def json_key(key):
+    if isinstance(key, (int, long)) and not isinstance(key, bool):
+        return str(key)
+    # rare key types: let json itself decide how they are spelled
+    return json.loads(json.dumps({key: None})).keys()[0]
+
+
+STRING_TYPES = (str, unicode)
+CONTAINER_TYPES = (dict, list, tuple)
+
+
+def json_compatible(obj):
+    """Coerces dict keys and tuples the way json.dumps does, so binary
+    responses carry exactly the same data as JSON ones. Containers that
+    need no changes are returned as is."""
+    if type(obj) is dict:
+        result = None
+        for key, value in obj.iteritems():
+            new_key = key if type(key) in STRING_TYPES else json_key(key)
+            new_value = json_compatible(value) if type(value) in CONTAINER_TYPES else value
+            if result is None and (new_key is not key or new_value is not value):
+                result = {}
+                for old_key, old_value in obj.iteritems():
+                    if old_key is key:
+                        break
+                    result[old_key] = old_value
+            if result is not None:
+                result[new_key] = new_value
+        return obj if result is None else result
+    if isinstance(obj, CONTAINER_TYPES):
+        return [json_compatible(value) if type(value) in CONTAINER_TYPES else value for value in obj]
+    return obj
+
+
+class JsonCodec(object):
+    content_type = "application/json"
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def log_body(self, data):
+        return data.decode("utf-8", "replace")
+
+
+class MsgpackCodec(object):
+    content_type = "application/msgpack"
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+    def dumps(self, obj):
+        return msgpack.packb(json_compatible(obj), use_bin_type=False)
+
+    def log_body(self, data):
+        return base64.b64encode(data)
+
+
+JSON = JsonCodec()
+MSGPACK = MsgpackCodec() if msgpack is not None else None
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+CODECS = {JSON.content_type: JSON}
+if MSGPACK is not None:
+    CODECS.update((content_type, MSGPACK) for content_type in MSGPACK_TYPES)
+
+
+def media_type(header):
+    return (header or "").split(";")[0].strip().lower()
+
+
+def request_codec(content_type):
+    """Codec for a request body. Unknown types fall back to JSON as before;
+    None means the type is known but its codec is not installed."""
+    name = media_type(content_type)
+    if name in CODECS:
+        return CODECS[name]
+    if name in MSGPACK_TYPES:
+        return None
+    return JSON
+
+
+def response_codec(accept, default):
+    for item in (accept or "").split(","):
+        name = media_type(item)
+        if name in CODECS:
+            return CODECS[name]
+    return default